@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Optional
+
+from config import BENCHMARK_FILE_PATH
+from helpers import format_list
+from meteorsys import ResponsysModuleParser
+from records import ModuleResult
+from synthetic import generate_library
+
+
+def build_parser() -> ResponsysModuleParser:
+    # A token is passed so the benchmarks never log in
+    return ResponsysModuleParser(
+        module_names=[],
+        find_containing_modules=True,
+        find_tables=False,
+        print_content=False,
+        token="benchmark",
+    )
+
+
+def build_benchmarks(library: dict) -> dict:
+    """Returns {name: callable} running one function over the whole library"""
+    parser = build_parser()
+    contents = list(library.values())
+    # As read from the cache by the folder scanner
+    raw_contents = [content.encode("utf-8") for content in contents]
+    queries = [query for c in contents for query in parser.parse_queries(c)]
+    includes = [name for c in contents for name in parser.parse_module(c) or []]
+    query_list = [
+        ModuleResult(path, parser.parse_queries(content), content=content)
+        for path, content in library.items()
+    ]
+
+    return {
+        "parse_module": lambda: [parser.parse_module(c) for c in contents],
+        "parse_queries": lambda: [parser.parse_queries(c) for c in contents],
+        "parse_module_bytes": lambda: [parser.parse_module(c) for c in raw_contents],
+        "parse_queries_bytes": lambda: [parser.parse_queries(c) for c in raw_contents],
+        "parse_table_information": lambda: [
+            parser.parse_table_information(q) for q in queries
+        ],
+        "build_module_path": lambda: [parser.build_module_path(i) for i in includes],
+        "format_list": lambda: format_list(query_list, True),
+    }
+
+
+def run_benchmark(func, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "best_seconds": min(timings),
+        "mean_seconds": sum(timings) / len(timings),
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def run_benchmarks(
+    seed: int = 0,
+    modules: int = 200,
+    size: int = 8000,
+    includes: int = 2,
+    lookup_density: float = 0.3,
+    nesting_depth: int = 2,
+    repeat: int = 5,
+    names: Optional[list] = None,
+) -> dict:
+    library = generate_library(
+        seed=seed,
+        modules=modules,
+        size=size,
+        includes=includes,
+        lookup_density=lookup_density,
+        nesting_depth=nesting_depth,
+    )
+    benchmarks = build_benchmarks(library)
+    return {
+        name: run_benchmark(func, repeat)
+        for name, func in benchmarks.items()
+        if not names or name in names
+    }
+
+
+def print_results(results: dict, baseline: Optional[dict] = None) -> None:
+    print(100 * "*")
+    for name, result in results.items():
+        line = "{:<25} best={:.4f}s mean={:.4f}s peak={:.0f}KB".format(
+            name,
+            result["best_seconds"],
+            result["mean_seconds"],
+            result["peak_memory_kb"],
+        )
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += "   time {:+.1f}% memory {:+.1f}%".format(
+                change(before["best_seconds"], result["best_seconds"]),
+                change(before["peak_memory_kb"], result["peak_memory_kb"]),
+            )
+        print(line)
+    print(100 * "*")
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the template parser.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modules", type=int, default=200)
+    parser.add_argument("--size", type=int, default=8000, help="characters/module")
+    parser.add_argument("--includes", type=int, default=2, help="includes/module")
+    parser.add_argument("--lookup-density", type=float, default=0.3)
+    parser.add_argument("--nesting-depth", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", help="benchmark names to run")
+    parser.add_argument("--save", action="store_true", help="save as the baseline")
+    parser.add_argument("--baseline", default=BENCHMARK_FILE_PATH)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        seed=args.seed,
+        modules=args.modules,
+        size=args.size,
+        includes=args.includes,
+        lookup_density=args.lookup_density,
+        nesting_depth=args.nesting_depth,
+        repeat=args.repeat,
+        names=args.only,
+    )
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from config import CHECKPOINT_INTERVAL_MODULES, CHECKPOINT_INTERVAL_SECONDS
+
+
+class ScanCheckpoint:
+    """Completed modules and partial results of a folder scan
+
+    Saved every CHECKPOINT_INTERVAL_MODULES modules or
+    CHECKPOINT_INTERVAL_SECONDS seconds, so a failed scan can be resumed.
+    """
+
+    def __init__(self, path: str, keyword: str, folder_names: list):
+        self.path = path
+        self.keyword = keyword
+        self.folder_names = list(folder_names)
+        self.completed = set()
+        self.matches = []
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ScanCheckpoint"]:
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            data = json.load(file)
+        checkpoint = cls(path, data["keyword"], data["folder_names"])
+        checkpoint.completed = set(data["completed"])
+        checkpoint.matches = [tuple(match) for match in data["matches"]]
+        return checkpoint
+
+    def is_compatible(self, keyword: str, folder_names: list) -> bool:
+        return self.keyword == keyword and self.folder_names == list(folder_names)
+
+    def mark_completed(self, module_name: str, match: Optional[tuple] = None) -> None:
+        with self.lock:
+            self.completed.add(module_name)
+            if match:
+                self.matches.append(match)
+            self.unsaved += 1
+            due = (
+                self.unsaved >= CHECKPOINT_INTERVAL_MODULES
+                or time.monotonic() - self.saved_at >= CHECKPOINT_INTERVAL_SECONDS
+            )
+        if due:
+            self.save()
+
+    def save(self) -> None:
+        with self.lock:
+            data = {
+                "keyword": self.keyword,
+                "folder_names": self.folder_names,
+                "completed": sorted(self.completed),
+                "matches": sorted(self.matches),
+            }
+            self.unsaved = 0
+            self.saved_at = time.monotonic()
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = "{}.tmp".format(self.path)
+            with open(tmp_path, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
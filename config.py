@@ -7,33 +7,107 @@ QUERY_FILE_PATH = "{}/{}".format(
     os.path.dirname(os.path.abspath(__file__)), "modules/QUERIES-{module_name}.notes"
 )
 SCAN_FILE_PATH = ""
+INDEX_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/INDEX.json"
+)
+CHECKPOINT_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/CHECKPOINT-{keyword}.json"
+)
+SNAPSHOT_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/SNAPSHOT-{name}.json"
+)
+DIFF_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/DIFF.notes"
+)
+EXPANDED_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/EXPANDED-{module_name}.htm"
+)
+UPDATE_DIFF_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/UPDATE.diff"
+)
+BENCHMARK_FILE_PATH = "{}/{}".format(
+    os.path.dirname(os.path.abspath(__file__)), "modules/BENCHMARKS.json"
+)
+
+
+class LazySettings:
+    """Settings read from the environment (or .env) on first access
+
+    Importing this module does not require the credentials or URLs to be
+    configured, so offline operations work without a .env file.
+    """
+
+    def __init__(self, **env_names):
+        self._env_names = env_names
+        self._values = {}
+
+    def __getattr__(self, name):
+        try:
+            env_name = self.__dict__["_env_names"][name]
+        except KeyError:
+            raise AttributeError(name)
+        values = self.__dict__["_values"]
+        if name not in values:
+            values[name] = config(env_name)
+        return values[name]
+
+    def configure(self, **values) -> None:
+        """Overrides settings, e.g. to point the client at another server"""
+        self._values.update(values)
+
+    def reset(self) -> None:
+        self._values.clear()
+
+
+settings = LazySettings(
+    # API credential configuration
+    USERNAME="USERNAME",
+    PASSWORD="PASSWORD",
+    TOKEN="AUTH_TOKEN",
+    # Responsys URL configuration
+    LOGIN_URL="LOGIN_URL",
+    CONTENT_URL="CONTENT_URL",
+    TABLE_URL="TABLE_URL",
+    TABLE_MEMBERS_URL="TABLE_MEMBERS_URL",
+    LIST_CONTENTS_URL="LIST_CONTENTS_URL",
+    UPDATE_CONTENT_URL="UPDATE_CONTENT_URL",
+)
+
+
+def __getattr__(name):
+    # Keeps `from config import LOGIN_URL` working for the lazy settings
+    try:
+        return getattr(settings, name)
+    except AttributeError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# API credential configuration
-USERNAME = config("USERNAME")
-PASSWORD = config("PASSWORD")
-TOKEN = config("AUTH_TOKEN")
 
 # Keys
 RESPONSYS_AUTH_TOKEN_KEY = "responsys_auth_token"
+FOLDER_TREE_KEY = "folder_tree:{folder_name}"
+FOLDER_TREE_TTL_SECONDS = 3600
 TOKEN_EXPIRATION_SECONDS = 3600
+DISTRIBUTED_SCAN_KEY = "distributed_scan:{scan_id}:{name}"
+DISTRIBUTED_SCAN_TTL_SECONDS = 24 * 3600
 
-# Responsys URL configuration
-LOGIN_URL = config("LOGIN_URL")
-CONTENT_URL = config("CONTENT_URL")
-TABLE_URL = config("TABLE_URL")
-TABLE_MEMBERS_URL = config("TABLE_MEMBERS_URL")
-LIST_CONTENTS_URL = config("LIST_CONTENTS_URL")
-UPDATE_CONTENT_URL = config("UPDATE_CONTENT_URL")
+# Throttled (429) and expired token (401) requests are retried this many times
+REQUEST_RETRIES = 2
+REQUEST_BACKOFF_SECONDS = 0.5
 
 # Regex Patterns
-CONTENT_LIBRARY_REGEX = r"(contentlibrary.*\.htm).*"
 QUERY_REGEX = r"(\$.*\))"
+VARIABLE_REGEX = r"\bLOOKUP\(\s*(?P<name>[A-Za-z_][A-Za-z0-9_]*)\s*\)"
+FUNCTION_REGEX = r"\b(?P<name>[A-Z][A-Z0-9_]*)\("
+# Includes are found anywhere, e.g. nested in $COND(...)$, and include their
+# $ delimiters when they are a whole expression
+INCLUDE_REGEX = r"(?P<open>\$)?\b(?P<word>documentnobr|document)\(\s*/?(?P<folder>contentlibrary/[^,()$]*?)\s*,\s*(?P<name>[^,()$]+?)\s*\)(?(open)\$)"
 TABLE_REGEX = r"(\((?P<folder_name>\!Master[A-Za-z]+),\s?(?P<table_name>[A-Za-z0-9_]+),\s?(?:pairs\()?\s?(?P<qpairs>(?P<qa>[A-Za-z0-9_]+),\s?(\bLOOKUP\(\b)?(?P<qv>[A-Za-z0-9_]+)\)?)+,?\s?(?P<qpairs2>(?P<qa2>[A-Za-z0-9_]+),\s?(\bLOOKUP\(\b)?(?P<qv2>[A-Za-z0-9_]+)\)?)?)"
 
 # Content Words
 DOCUMENT_WORD = "document"
 DOCUMENTNOBR_WORD = "documentnobr"
 CONTENT_LIBRARY_WORD = "contentlibrary"
+CONTENT_LIBRARY_EXTENSION = ".htm"
 
 # Switches
 FIND_CONTAINING_MODULES = True
@@ -41,6 +115,53 @@ FIND_CONTAINING_MODULES_DEPTH = 10
 FIND_TABLES = False
 PRINT_QUERIES = True
 PRINT_CONTENT = True
+# Parse results keep the module content, otherwise it is reloaded from the
+# cache when it is read, e.g. by the report
+KEEP_CONTENT = False
+
+# Parse results are cached by content hash, bump the version whenever the
+# parse_* methods change what they extract
+PARSER_VERSION = 1
+PARSE_CACHE_KEY = "parse_result:{version}:{content_hash}"
+PARSE_CACHE_SIZE = 2048
+PARSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Keyword used by the interactive folder scan
+SCAN_KEYWORD = "EMAIL_ADDRESS_"
+
+# Run metrics are written here when set, as JSON for .json paths and in the
+# Prometheus text format otherwise
+METRICS_FILE_PATH = None
+
+# Folder scans run as a pipeline of stages connected by bounded queues
+PIPELINE_QUEUE_SIZE = 100
+FETCH_WORKERS = 8
+PARSE_WORKERS = 2
+# Scan checkpoints are saved after this many modules or seconds
+CHECKPOINT_INTERVAL_MODULES = 50
+CHECKPOINT_INTERVAL_SECONDS = 30
+# Modules claimed by a distributed scan worker are claimed again by another
+# worker when they are not done within the lease, at most this many times
+SCAN_LEASE_SECONDS = 120
+SCAN_MAX_ATTEMPTS = 3
+# Seconds between progress checks of the coordinator and idle workers
+SCAN_POLL_SECONDS = 1.0
+# Folders listed concurrently when scanning subfolders
+FOLDER_WALK_WORKERS = 8
+# Modules fetched per batch, sharing one cache round trip
+BULK_FETCH_SIZE = 25
+
+# Bulk updates are pushed by this many workers, at most this many requests
+# per second (0 for no limit)
+UPDATE_WORKERS = 4
+UPDATE_RATE_PER_SECOND = 5
+
+# Number of jobs run concurrently by the job runner
+JOB_WORKERS = 4
+
+# Address of the daemon serving parse, scan and lookup requests
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
 
 # List of folder names to scan
 FOLDER_NAMES = [
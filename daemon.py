@@ -0,0 +1,377 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from config import (
+    DAEMON_HOST,
+    DAEMON_PORT,
+    FETCH_WORKERS,
+    FOLDER_NAMES,
+    INDEX_FILE_PATH,
+    PARSE_WORKERS,
+    SCAN_KEYWORD,
+)
+from exceptions import BadRequestException
+from expander import TemplateExpander
+from indexer import INDEX_KINDS, ContentIndex
+from meteorsys import (
+    ResponsysFolderScanner,
+    ResponsysModuleParser,
+    ResponsysParser,
+    build_module_list,
+)
+from metrics import metrics
+from redis_ops import delete_from_redis
+
+
+class SingleFlight:
+    """Runs identical calls which are in flight at the same time only once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[str, Future] = {}
+
+    def do(self, key: str, func: Callable) -> Tuple[object, bool]:
+        """Returns the result of func and whether it was shared with another call"""
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future.result(), False
+
+
+PARAM_KINDS = {
+    str: "a string",
+    int: "an integer",
+    bool: "true or false",
+    list: "a list of strings",
+}
+
+
+def get_param(params: dict, name: str, kind: type, default=None, minimum=None):
+    """Returns params[name], or default, raising BadRequestException if not kind"""
+    value = params.get(name, default)
+    # bool is an int, so flags can not be given as worker counts either
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise BadRequestException("{} must be {}".format(name, PARAM_KINDS[kind]))
+    if kind is list and not all(isinstance(item, str) for item in value):
+        raise BadRequestException("{} must be a list of strings".format(name))
+    if minimum is not None and value < minimum:
+        raise BadRequestException("{} must be at least {}".format(name, minimum))
+    return value
+
+
+class MeteorsysDaemon:
+    """Serves parse, scan, expand and lookup requests from a warm process
+
+    The authenticated session, Redis connections, parse cache, expanded
+    templates and index stay in memory between requests, and identical
+    requests in flight at the same time are answered by one run.
+    """
+
+    def __init__(self, index_path: str = INDEX_FILE_PATH):
+        self.session = requests.Session()
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.token = None
+        self.index = None
+        self.index_mtime = None
+        self.flights = SingleFlight()
+        # Expanded subtrees stay cached until their modules are invalidated
+        self.expander = TemplateExpander(self.load_content)
+        self.request_count = 0
+        self.coalesced_count = 0
+
+    def client_kwargs(self) -> dict:
+        with self.lock:
+            if self.token is None:
+                self.token = ResponsysParser(None, session=self.session).token
+            return {"session": self.session, "token": self.token}
+
+    def keep_token(self, client: ResponsysParser) -> None:
+        # A client refreshes an expired token, later clients start with it
+        with self.lock:
+            self.token = client.token
+
+    def load_content(self, module_name: str) -> Optional[str]:
+        client = ResponsysParser(None, **self.client_kwargs())
+        try:
+            return client.get_content(module_name)
+        except Exception:
+            return None
+        finally:
+            self.keep_token(client)
+
+    def get_index(self) -> ContentIndex:
+        """Returns the index, reloaded when the index file changed"""
+        mtime = (
+            os.path.getmtime(self.index_path)
+            if os.path.exists(self.index_path)
+            else None
+        )
+        with self.lock:
+            if self.index is None or mtime != self.index_mtime:
+                self.index = ContentIndex.load(self.index_path)
+                self.index_mtime = mtime
+            return self.index
+
+    def parse(self, params: dict) -> dict:
+        client = ResponsysModuleParser(
+            module_names=self.module_names(params),
+            find_containing_modules=get_param(
+                params, "find_containing_modules", bool, False
+            ),
+            find_tables=get_param(params, "find_tables", bool, False),
+            print_content=False,
+            **self.client_kwargs(),
+        )
+        results = client.parse_modules()
+        self.keep_token(client)
+        return {
+            "results": [
+                {
+                    "module_name": result.module_name,
+                    "queries": result.queries,
+                    "called_modules": result.called_modules,
+                    "tables": result.tables,
+                    "members": result.members,
+                }
+                for list_of_queries in results
+                for result in list_of_queries
+            ]
+        }
+
+    def scan(self, params: dict) -> dict:
+        keyword = get_param(params, "keyword", str, SCAN_KEYWORD)
+        folder_names = get_param(params, "folders", list, FOLDER_NAMES)
+        fetch_workers = get_param(
+            params, "fetch_workers", int, FETCH_WORKERS, minimum=1
+        )
+        parse_workers = get_param(
+            params, "parse_workers", int, PARSE_WORKERS, minimum=1
+        )
+        recursive = get_param(params, "recursive", bool, False)
+        # Scans of the same keyword must not share the default checkpoint
+        with tempfile.TemporaryDirectory() as directory:
+            client = ResponsysFolderScanner(
+                keyword=keyword,
+                folder_names=folder_names,
+                fetch_workers=fetch_workers,
+                parse_workers=parse_workers,
+                recursive=recursive,
+                checkpoint_path=os.path.join(directory, "CHECKPOINT.json"),
+                **self.client_kwargs(),
+            )
+            matches = client.scan_folder_for_keyword(
+                keyword, folder_names, write_report=False
+            )
+        self.keep_token(client)
+        return {
+            "keyword": keyword,
+            "matches": [
+                {"folder_name": folder_name, "module_name": module_name}
+                for folder_name, _, module_name in matches
+            ],
+        }
+
+    def module_names(self, params: dict) -> list:
+        if not params.get("modules"):
+            raise BadRequestException("modules is required")
+        return build_module_list(
+            get_param(params, "modules", list),
+            get_param(params, "folder", str, FOLDER_NAMES[0]),
+        )
+
+    def expand(self, params: dict) -> dict:
+        results = []
+        for module_name in self.module_names(params):
+            content = self.expander.expand(module_name)
+            results.append(
+                {
+                    "module_name": module_name,
+                    "content": content,
+                    "size": len(content.encode("utf-8")) if content else None,
+                }
+            )
+        return {"results": results}
+
+    def invalidate(self, params: dict) -> dict:
+        """Forgets changed modules, their cached content and expanded ancestors"""
+        invalidated = set()
+        for module_name in self.module_names(params):
+            delete_from_redis(module_name)
+            invalidated |= self.expander.invalidate(module_name)
+        return {"invalidated": sorted(invalidated)}
+
+    def lookup(self, params: dict) -> dict:
+        term = get_param(params, "term", str, "")
+        kind = get_param(params, "kind", str, "")
+        if not term:
+            raise BadRequestException("term is required")
+        if kind and kind not in INDEX_KINDS:
+            raise BadRequestException(
+                "kind must be one of {}".format(", ".join(INDEX_KINDS))
+            )
+        return {"term": term, "modules": self.get_index().lookup(term, kind)}
+
+    def health(self, params: dict) -> dict:
+        return {
+            "status": "ok",
+            "requests": self.request_count,
+            "coalesced": self.coalesced_count,
+        }
+
+    def handle(self, name: str, params: dict) -> Tuple[int, dict]:
+        """Returns the status and response of a request to endpoint name"""
+        handlers = {
+            "parse": self.parse,
+            "scan": self.scan,
+            "expand": self.expand,
+            "invalidate": self.invalidate,
+            "lookup": self.lookup,
+            "health": self.health,
+        }
+        if name not in handlers:
+            return 404, {"error": "Unknown endpoint: {}".format(name)}
+        with self.lock:
+            self.request_count += 1
+        if name == "health":
+            return 200, self.health(params)
+
+        key = json.dumps([name, params], sort_keys=True)
+        try:
+            with metrics.stage("daemon_{}".format(name)):
+                result, shared = self.flights.do(key, lambda: handlers[name](params))
+        except BadRequestException as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": repr(e)}
+        if shared:
+            with self.lock:
+                self.coalesced_count += 1
+        return 200, result
+
+
+# Their parameters are lists and flags, which query strings can not express
+POST_ONLY_ENDPOINTS = ("parse", "scan", "expand", "invalidate")
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, data: dict) -> None:
+        self.send_body(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        name = url.path.strip("/")
+        if name == "metrics":
+            body = metrics.to_prometheus().encode("utf-8")
+            return self.send_body(200, body, "text/plain; version=0.0.4")
+        if name in POST_ONLY_ENDPOINTS:
+            return self.send_json(405, {"error": "Use POST for {}".format(name)})
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.send_json(*self.server.app.handle(name, params))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            params = json.loads(body or b"{}")
+        except ValueError:
+            return self.send_json(400, {"error": "Body is not JSON"})
+        if not isinstance(params, dict):
+            return self.send_json(400, {"error": "Body is not a JSON object"})
+        self.send_json(
+            *self.server.app.handle(urlsplit(self.path).path.strip("/"), params)
+        )
+
+
+class DaemonHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, daemon: MeteorsysDaemon, host: str = DAEMON_HOST, port: int = DAEMON_PORT
+    ):
+        super().__init__((host, port), DaemonHandler)
+        self.app = daemon
+
+
+class UnixDaemonHandler(DaemonHandler):
+    # TCP_NODELAY can not be set on Unix sockets
+    disable_nagle_algorithm = False
+
+
+class DaemonUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, daemon: MeteorsysDaemon, path: str):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, UnixDaemonHandler)
+        self.app = daemon
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve parse, scan and lookup requests from a warm process."
+    )
+    parser.add_argument("--host", default=DAEMON_HOST)
+    parser.add_argument("--port", type=int, default=DAEMON_PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead")
+    parser.add_argument("--index", default=INDEX_FILE_PATH)
+    args = parser.parse_args(argv)
+
+    daemon = MeteorsysDaemon(index_path=args.index)
+    if args.socket:
+        server = DaemonUnixServer(daemon, args.socket)
+        print("Listening on {}".format(args.socket))
+    else:
+        server = DaemonHTTPServer(daemon, args.host, args.port)
+        print("Listening on http://{}:{}".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
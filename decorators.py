@@ -1,5 +1,7 @@
 import inspect
+import time
 
+from metrics import metrics
 from redis_ops import get_from_redis, save_to_redis
 
 
@@ -8,7 +10,9 @@ def get_from_redis_or_set(func):
         current_frame = inspect.currentframe()
         _, _, _, values = inspect.getargvalues(current_frame)
         module_name = values["args"][1]
+        start = time.perf_counter()
         content = get_from_redis(module_name)
+        metrics.record_cache("redis", bool(content), time.perf_counter() - start)
         if content:
             return content
         else:
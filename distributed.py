@@ -0,0 +1,204 @@
+import json
+import time
+from typing import Dict, List, Optional
+
+from redis.exceptions import WatchError
+
+from config import (
+    DISTRIBUTED_SCAN_KEY,
+    DISTRIBUTED_SCAN_TTL_SECONDS,
+    SCAN_LEASE_SECONDS,
+    SCAN_MAX_ATTEMPTS,
+)
+from redis_ops import get_redis_client
+
+# Results of the modules of a distributed scan
+MATCH = "match"
+NO_MATCH = "no_match"
+FAILED = "failed"
+
+
+class ScanQueue:
+    """Modules of a distributed scan, claimed from Redis by workers with leases
+
+    Pending modules are a sorted set scored by the time they may be claimed.
+    A claim moves the score to the end of the lease, so the modules of a
+    worker which died are claimed again once its lease expired. Modules
+    claimed more than SCAN_MAX_ATTEMPTS times are given up as failed.
+    """
+
+    def __init__(self, scan_id: str):
+        self.scan_id = scan_id
+
+    def key(self, name: str) -> str:
+        return DISTRIBUTED_SCAN_KEY.format(scan_id=self.scan_id, name=name)
+
+    @property
+    def keys(self) -> List[str]:
+        return [
+            self.key(name)
+            for name in ("info", "folders", "pending", "attempts", "results")
+        ]
+
+    @staticmethod
+    def encode(item: tuple) -> str:
+        return json.dumps(list(item))
+
+    @staticmethod
+    def decode(member) -> tuple:
+        return tuple(json.loads(member))
+
+    def create(self, keyword: str, folder_names: list) -> None:
+        """Starts a scan, dropping an earlier scan of the same id"""
+        client = get_redis_client()
+        pipeline = client.pipeline()
+        pipeline.delete(*self.keys)
+        pipeline.hset(
+            self.key("info"),
+            mapping={
+                "keyword": keyword,
+                "folder_names": json.dumps(list(folder_names)),
+                "listed": 0,
+                "total": 0,
+            },
+        )
+        pipeline.expire(self.key("info"), DISTRIBUTED_SCAN_TTL_SECONDS)
+        pipeline.execute()
+
+    def info(self) -> Optional[dict]:
+        info = get_redis_client().hgetall(self.key("info"))
+        if not info:
+            return None
+        info = {
+            key.decode("utf-8"): value.decode("utf-8") for key, value in info.items()
+        }
+        return {
+            "keyword": info["keyword"],
+            "folder_names": json.loads(info["folder_names"]),
+            "listed": info["listed"] == "1",
+            "total": int(info["total"]),
+        }
+
+    def enqueue(self, folder_name: str, module_names: list) -> None:
+        items = {
+            self.encode((folder_name, module_index, module_name)): 0
+            for module_index, module_name in enumerate(module_names)
+        }
+        pipeline = get_redis_client().pipeline()
+        pipeline.hset(self.key("folders"), folder_name, len(module_names))
+        if items:
+            pipeline.zadd(self.key("pending"), items, nx=True)
+            pipeline.hincrby(self.key("info"), "total", len(items))
+        self.expire(pipeline)
+        pipeline.execute()
+
+    def expire(self, pipeline) -> None:
+        """Expires the keys of the scan, in case the coordinator never deletes them"""
+        for key in self.keys:
+            pipeline.expire(key, DISTRIBUTED_SCAN_TTL_SECONDS)
+
+    def mark_listed(self) -> None:
+        """Marks that all folders are enqueued, workers stop once they are done"""
+        get_redis_client().hset(self.key("info"), "listed", 1)
+
+    def claim(self, count: int, lease_seconds: float = SCAN_LEASE_SECONDS) -> list:
+        """Returns up to count (folder name, module index, module name) items"""
+        pending_key = self.key("pending")
+        with get_redis_client().pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(pending_key)
+                    now = time.time()
+                    members = pipeline.zrangebyscore(
+                        pending_key, "-inf", now, start=0, num=count
+                    )
+                    if not members:
+                        return []
+                    pipeline.multi()
+                    pipeline.zadd(
+                        pending_key,
+                        {member: now + lease_seconds for member in members},
+                        xx=True,
+                    )
+                    for member in members:
+                        pipeline.hincrby(self.key("attempts"), member, 1)
+                    pipeline.expire(self.key("attempts"), DISTRIBUTED_SCAN_TTL_SECONDS)
+                    attempts = pipeline.execute()[1 : len(members) + 1]
+                    break
+                except WatchError:
+                    # Another worker claimed or completed modules meanwhile
+                    continue
+
+        claimed, failed = [], {}
+        for member, attempt in zip(members, attempts):
+            if attempt > SCAN_MAX_ATTEMPTS:
+                failed[member] = FAILED
+            else:
+                claimed.append(self.decode(member))
+        if failed:
+            print(
+                "Giving up {} modules after {} attempts".format(
+                    len(failed), SCAN_MAX_ATTEMPTS
+                )
+            )
+            self.finish(failed)
+        return claimed
+
+    def finish(self, results: dict) -> None:
+        pipeline = get_redis_client().pipeline()
+        pipeline.hset(self.key("results"), mapping=results)
+        pipeline.zrem(self.key("pending"), *results)
+        pipeline.expire(self.key("results"), DISTRIBUTED_SCAN_TTL_SECONDS)
+        pipeline.execute()
+
+    def complete(self, matches: Dict[tuple, bool]) -> None:
+        """Records whether each of the claimed items matched"""
+        if matches:
+            self.finish(
+                {
+                    self.encode(item): MATCH if match else NO_MATCH
+                    for item, match in matches.items()
+                }
+            )
+
+    def retry(self, items: list) -> None:
+        """Releases claimed items, to be claimed again right away"""
+        if items:
+            get_redis_client().zadd(
+                self.key("pending"),
+                {self.encode(item): time.time() for item in items},
+                xx=True,
+            )
+
+    def is_finished(self) -> bool:
+        info = self.info()
+        return info is None or (
+            info["listed"] and not get_redis_client().zcard(self.key("pending"))
+        )
+
+    def progress(self) -> dict:
+        client = get_redis_client()
+        info = self.info() or {"total": 0}
+        return {
+            "total": info["total"],
+            "done": client.hlen(self.key("results")),
+            "pending": client.zcard(self.key("pending")),
+        }
+
+    def folders(self) -> Dict[str, int]:
+        """Returns {folder name: number of modules} of the enqueued folders"""
+        folders = get_redis_client().hgetall(self.key("folders"))
+        return {
+            folder_name.decode("utf-8"): int(count)
+            for folder_name, count in folders.items()
+        }
+
+    def results(self) -> Dict[tuple, str]:
+        results = get_redis_client().hgetall(self.key("results"))
+        return {
+            self.decode(member): result.decode("utf-8")
+            for member, result in results.items()
+        }
+
+    def delete(self) -> None:
+        get_redis_client().delete(*self.keys)
@@ -8,3 +8,7 @@ class TokenExpiredException(Exception):
 
 class RequestFailedException(Exception):
     pass
+
+
+class BadRequestException(Exception):
+    pass
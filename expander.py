@@ -0,0 +1,129 @@
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+from config import DOCUMENTNOBR_WORD, INCLUDE_REGEX
+from indexer import hash_content
+from metrics import metrics
+
+
+class TemplateExpander:
+    """Inlines document(...) and documentnobr(...) includes recursively
+
+    Includes nested in other tags, e.g. $COND(..., document(...))$, are
+    replaced by the content they render. Expanded subtrees are cached by a
+    hash of the module's content and of the subtree hashes of its includes,
+    so a fragment shared by many templates is expanded once. Missing and
+    cyclic includes are left as they are, and subtrees with missing modules
+    are not cached, so the modules are loaded again by the next expansion.
+    """
+
+    def __init__(self, load_content: Callable[[str], Optional[str]]):
+        self.load_content = load_content
+        self.pattern = re.compile(INCLUDE_REGEX)
+        self.lock = threading.RLock()
+        self.contents: Dict[str, Optional[str]] = {}
+        self.includes: Dict[str, List[str]] = {}
+        self.dependents: Dict[str, Set[str]] = {}
+        self.subtree_hashes: Dict[str, str] = {}
+        # Modules which failed to load during the current expansion
+        self.missing: Set[str] = set()
+        # subtree hash -> expanded content
+        self.expanded: Dict[str, str] = {}
+
+    @staticmethod
+    def include_path(match: re.Match) -> str:
+        return "/{}/{}".format(match.group("folder").strip("/"), match.group("name"))
+
+    def get_content(self, module_name: str) -> Optional[str]:
+        if module_name in self.missing:
+            return None
+        if module_name not in self.contents:
+            content = self.load_content(module_name)
+            if content is None:
+                self.missing.add(module_name)
+                return None
+            if isinstance(content, bytes):
+                content = content.decode("utf-8")
+            self.contents[module_name] = content
+            includes = [
+                self.include_path(match) for match in self.pattern.finditer(content)
+            ]
+            self.includes[module_name] = includes
+            for include in includes:
+                self.dependents.setdefault(include, set()).add(module_name)
+        return self.contents[module_name]
+
+    def subtree_hash(self, module_name: str, stack: tuple = ()) -> Optional[str]:
+        """Returns the hash of a module and everything it includes"""
+        if module_name in self.subtree_hashes:
+            return self.subtree_hashes[module_name]
+        content = self.get_content(module_name)
+        if content is None:
+            return None
+
+        parts = [hash_content(content)]
+        complete = True
+        for include in self.includes[module_name]:
+            if include in stack or include == module_name:
+                parts.append("cycle:" + include)
+                continue
+            include_hash = self.subtree_hash(include, stack + (module_name,))
+            parts.append(include_hash or "missing:" + include)
+            complete = complete and include in self.subtree_hashes
+        subtree_hash = hash_content("\n".join(parts))
+        if complete:
+            self.subtree_hashes[module_name] = subtree_hash
+        return subtree_hash
+
+    def expand(self, module_name: str, stack: tuple = ()) -> Optional[str]:
+        """Returns the content of a module with all includes inlined"""
+        with self.lock:
+            if not stack:
+                self.missing.clear()
+            key = self.subtree_hash(module_name)
+            if key is None:
+                return None
+            expanded = self.expanded.get(key)
+            metrics.record_cache("expanded", expanded is not None)
+            if expanded is not None:
+                return expanded
+
+            stack = stack + (module_name,)
+
+            def inline(match):
+                include = self.include_path(match)
+                if include in stack:
+                    return match.group(0)
+                content = self.expand(include, stack)
+                if content is None:
+                    return match.group(0)
+                if match.group("word") == DOCUMENTNOBR_WORD:
+                    content = content.strip("\r\n")
+                return content
+
+            with metrics.stage("include_expansion"):
+                expanded = self.pattern.sub(inline, self.contents[module_name])
+            if module_name in self.subtree_hashes:
+                self.expanded[key] = expanded
+            return expanded
+
+    def invalidate(self, module_name: str) -> Set[str]:
+        """Forgets a changed module, returns it and the ancestors to re-expand"""
+        with self.lock:
+            invalidated = set()
+            pending = [module_name]
+            while pending:
+                name = pending.pop()
+                if name in invalidated:
+                    continue
+                invalidated.add(name)
+                subtree_hash = self.subtree_hashes.pop(name, None)
+                if subtree_hash:
+                    self.expanded.pop(subtree_hash, None)
+                pending.extend(self.dependents.get(name, ()))
+
+            self.contents.pop(module_name, None)
+            for include in self.includes.pop(module_name, []):
+                self.dependents.get(include, set()).discard(module_name)
+            return invalidated
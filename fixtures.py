@@ -41,6 +41,14 @@ TABLE_MEMBERS_RESPONSE = {
     },
 }
 
+TABLE_MEMBERS_BATCH_RESPONSE = {
+    "recordData": {
+        "fieldNames": ["TITLE", "ID"],
+        "records": [["Jane Doe", "2"], ["John Doe", "1"]],
+        "mapTemplateName": None,
+    },
+}
+
 LIST_CONTENTS_RESPONSE = {
     "documents": [
         {
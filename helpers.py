@@ -1,57 +1,72 @@
 import json
+import os
 from typing import List
 
 from config import FIND_CONTAINING_MODULES_DEPTH, PRINT_QUERIES, QUERY_FILE_PATH
+from records import ModuleResult
 
 
 def write_queries_to_file(module_name: str, content: str) -> None:
     module_name = module_name.replace("/", "-")
     module_name = module_name.replace(".htm", "")
 
-    file = open(QUERY_FILE_PATH.format(module_name=module_name), "w")
+    file_path = QUERY_FILE_PATH.format(module_name=module_name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    file = open(file_path, "w")
     file.write(content)
     file.close()
 
 
 def dump_list(query_list: list, print_content: bool) -> None:
-    content = ""
     module_name = query_list[0]["module_name"] if query_list else ""
-    for query in query_list:
+    write_queries_to_file(module_name, format_list(query_list, print_content))
+
+
+def format_list(query_list: list, print_content: bool) -> str:
+    """Formats ModuleResult records, or the dicts parse_content used to return"""
+    results = [
+        query if isinstance(query, ModuleResult) else ModuleResult.from_dict(query)
+        for query in query_list
+    ]
+    content = ""
+    for result in results:
         content += 100 * "-"
-        content += query["module_name"]
+        content += result.module_name
         content += 100 * "-"
         content += "\n\n"
-        for key, value in query.items():
-            # Print Table Information
-            if key.startswith("TABLE"):
-                content += "\t\t" + (50 * "*") + " TABLE " + (50 * "*") + "\n\n\n"
-                content += "\t\tTable Name: {}".format(key.split("-")[1])
-                content += "\t\tFields: {}".format(value)
-                content += "\n\n"
-            # Print Query Information
-            elif key == "queries" and PRINT_QUERIES:
-                content += "\t\t" + (50 * "*") + " QUERIES " + (50 * "*") + "\n\n\n"
-                for q in value:
-                    content += "\t\t" + q
-                    content += "\n\n"
-            # Print Content Information
-            elif key == "content" and print_content:
-                content += "\t\t" + (50 * "*") + " CONTENT " + (50 * "*") + "\n\n\n"
-                content += "\t\t" + value
-                content += "\n\n"
-            elif key.startswith("MEMBER"):
-                content += "\t\t" + (50 * "*") + " MEMBER " + (50 * "*") + "\n\n\n"
-                content += "\t\t{}: {}".format(key.split("-")[1], value)
+        # Print Query Information
+        if PRINT_QUERIES:
+            content += "\t\t" + (50 * "*") + " QUERIES " + (50 * "*") + "\n\n\n"
+            for q in result.queries:
+                content += "\t\t" + q
                 content += "\n\n"
+        # Print Content Information
+        if print_content:
+            value = result.content or ""
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            content += "\t\t" + (50 * "*") + " CONTENT " + (50 * "*") + "\n\n\n"
+            content += "\t\t" + value
+            content += "\n\n"
+        # Print Table Information
+        for table_name, fields in result.tables.items():
+            content += "\t\t" + (50 * "*") + " TABLE " + (50 * "*") + "\n\n\n"
+            content += "\t\tTable Name: {}".format(table_name)
+            content += "\t\tFields: {}".format(fields)
+            content += "\n\n"
+        for qv, member in result.members.items():
+            content += "\t\t" + (50 * "*") + " MEMBER " + (50 * "*") + "\n\n\n"
+            content += "\t\t{}: {}".format(qv, member)
+            content += "\n\n"
 
     # Print Module Call Tree
     content += (50 * "*") + " MODULE CALL TREE " + (50 * "*")
     content += "\t\t\n\n\n"
-    for data in map(lambda q: {q["module_name"]: q["called_modules"]}, query_list):
-        data_content = json.dumps(data)
+    for result in results:
+        data_content = json.dumps({result.module_name: result.called_modules})
         content += data_content
 
-    write_queries_to_file(module_name, content)
+    return content
 
 
 def print_run_context(
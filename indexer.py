@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import INDEX_FILE_PATH
+
+INDEX_KINDS = ("variable", "function", "table")
+
+
+def hash_content(content) -> str:
+    """Returns a stable hash of a module's content"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+class ContentIndex:
+    """Inverted index of Responsys variables, functions and tables per module"""
+
+    def __init__(self):
+        # kind -> term -> module name -> offsets
+        self.postings: Dict[str, Dict[str, Dict[str, List[int]]]] = {
+            kind: {} for kind in INDEX_KINDS
+        }
+        # module name -> content hash, used to skip unchanged modules
+        self.modules: Dict[str, str] = {}
+
+    def is_current(self, module_name: str, content_hash: str) -> bool:
+        return self.modules.get(module_name) == content_hash
+
+    def add_module(
+        self,
+        module_name: str,
+        content_hash: str,
+        occurrences: Iterable[Tuple[str, str, int]],
+    ) -> None:
+        """Replaces all postings of a module with the given occurrences"""
+        self.remove_module(module_name)
+        for kind, term, offset in occurrences:
+            modules = self.postings[kind].setdefault(term, {})
+            modules.setdefault(module_name, []).append(offset)
+        self.modules[module_name] = content_hash
+
+    def remove_module(self, module_name: str) -> None:
+        if module_name not in self.modules:
+            return
+        for terms in self.postings.values():
+            for term in [t for t, modules in terms.items() if module_name in modules]:
+                del terms[term][module_name]
+                if not terms[term]:
+                    del terms[term]
+        del self.modules[module_name]
+
+    def lookup(self, term: str, kind: Optional[str] = None) -> Dict[str, List[int]]:
+        """Returns the modules and offsets where the term occurs"""
+        kinds = (kind,) if kind else INDEX_KINDS
+        result = {}
+        for k in kinds:
+            for module_name, offsets in self.postings[k].get(term, {}).items():
+                result.setdefault(module_name, []).extend(offsets)
+        for offsets in result.values():
+            offsets.sort()
+        return result
+
+    def terms(self, kind: str) -> List[str]:
+        return sorted(self.postings[kind])
+
+    def save(self, path: str = INDEX_FILE_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as file:
+            json.dump({"modules": self.modules, "postings": self.postings}, file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = INDEX_FILE_PATH) -> "ContentIndex":
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        with open(path) as file:
+            data = json.load(file)
+        index.modules = data["modules"]
+        for kind in INDEX_KINDS:
+            index.postings[kind] = data["postings"].get(kind, {})
+        return index
@@ -1,40 +1,114 @@
+import argparse
+import json
+import os
 import re
 import sys
-from typing import Optional
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import requests
 from requests import Response
 
+from checkpoint import ScanCheckpoint
 from config import (
-    CONTENT_LIBRARY_REGEX,
+    BULK_FETCH_SIZE,
+    CHECKPOINT_FILE_PATH,
+    CONTENT_LIBRARY_EXTENSION,
     CONTENT_LIBRARY_WORD,
-    CONTENT_URL,
+    DIFF_FILE_PATH,
+    EXPANDED_FILE_PATH,
+    FETCH_WORKERS,
     FIND_CONTAINING_MODULES_DEPTH,
     FOLDER_NAMES,
-    LIST_CONTENTS_URL,
-    LOGIN_URL,
-    PASSWORD,
+    FOLDER_TREE_KEY,
+    FOLDER_TREE_TTL_SECONDS,
+    FOLDER_WALK_WORKERS,
+    FUNCTION_REGEX,
+    INDEX_FILE_PATH,
+    JOB_WORKERS,
+    KEEP_CONTENT,
+    METRICS_FILE_PATH,
+    PARSE_WORKERS,
+    PIPELINE_QUEUE_SIZE,
     QUERY_REGEX,
+    REQUEST_BACKOFF_SECONDS,
+    REQUEST_RETRIES,
     RESPONSYS_AUTH_TOKEN_KEY,
-    TABLE_MEMBERS_URL,
+    SCAN_KEYWORD,
+    SCAN_LEASE_SECONDS,
+    SCAN_POLL_SECONDS,
+    SNAPSHOT_FILE_PATH,
     TABLE_REGEX,
-    TABLE_URL,
     TABLES_TO_QUERIES_DICT,
     TOKEN_EXPIRATION_SECONDS,
-    USERNAME,
+    UPDATE_DIFF_FILE_PATH,
+    UPDATE_RATE_PER_SECOND,
+    UPDATE_WORKERS,
+    VARIABLE_REGEX,
+    settings,
 )
 from decorators import get_from_redis_or_set
+from distributed import FAILED as SCAN_FAILED
+from distributed import MATCH, ScanQueue
 from exceptions import RequestFailedException, TokenException, TokenExpiredException
+from expander import TemplateExpander
 from helpers import dump_list, print_run_context, write_queries_to_file
-from redis_ops import get_from_redis, save_to_redis
+from indexer import INDEX_KINDS, ContentIndex, hash_content
+from metrics import metrics, report_metrics
+from parse_cache import ParsedContent, parse_cache
+from pipeline import Pipeline, Stage
+from records import ModuleResult, ScanMatch
+from redis_ops import (
+    delete_from_redis,
+    get_from_redis,
+    get_many_from_redis,
+    save_many_to_redis,
+    save_to_redis,
+)
+from snapshot import LibrarySnapshot, diff_snapshots, format_diff
+from updater import (
+    CONFLICT,
+    FAILED,
+    UPDATED,
+    ContentUpdate,
+    RateLimiter,
+    Replacement,
+    format_updates,
+    plan_update,
+)
 
 # TODO: If no running Redis, ImproperlyConfigured should be raised
 
+# Content is bytes when read from the cache undecoded, str otherwise
+Content = Union[str, bytes]
+
+
+def as_content_type(text: str, content: Content) -> Content:
+    return text.encode("utf-8") if isinstance(content, bytes) else text
+
+
+@lru_cache(maxsize=None)
+def compile_bytes_regex(regex: str, flags: int = 0) -> re.Pattern:
+    return re.compile(regex.encode("utf-8"), flags)
+
+
+def compile_regex(regex: str, content: Content, flags: int = 0) -> re.Pattern:
+    """Returns regex compiled to match content of the same type"""
+    if isinstance(content, bytes):
+        return compile_bytes_regex(regex, flags)
+    return re.compile(regex, flags)
+
 
 class ResponsysParser:
-    def __init__(self, parser_client):
+    def __init__(self, parser_client, session=None, token=None):
         self.parser_client = parser_client
-        self.token = self.get_auth_token()
+        # A shared requests.Session reuses connections across clients and jobs
+        self.session = session or requests
+        self.token = token or self.get_auth_token()
+        self.table_fields = {}
 
     def is_success(self, response: Response) -> bool:
         if response.ok:
@@ -47,15 +121,50 @@ class ResponsysParser:
                 raise TokenExpiredException
             raise RequestFailedException
 
+    def send(self, method: str, endpoint: str, url: str, **kwargs) -> Response:
+        """Sends a request on the session and records its latency and size"""
+        start = time.perf_counter()
+        status, size = "error", 0
+        try:
+            response = getattr(self.session, method)(url, **kwargs)
+            status, size = str(response.status_code), len(response.content or b"")
+            return response
+        finally:
+            metrics.record_request(endpoint, time.perf_counter() - start, size, status)
+
+    def request(self, method: str, endpoint: str, url: str, **kwargs) -> Response:
+        """Sends a request, retrying throttled (429) and expired token (401) calls"""
+        for attempt in range(REQUEST_RETRIES + 1):
+            response = self.send(method, endpoint, url, **kwargs)
+            if attempt == REQUEST_RETRIES:
+                break
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After")
+                time.sleep(
+                    float(retry_after)
+                    if retry_after
+                    else REQUEST_BACKOFF_SECONDS * 2**attempt
+                )
+            elif response.status_code == 401 and "headers" in kwargs:
+                self.token = self.refresh_auth_token()
+                kwargs["headers"] = {**kwargs["headers"], "Authorization": self.token}
+            else:
+                break
+        return response
+
+    def refresh_auth_token(self) -> str:
+        delete_from_redis(RESPONSYS_AUTH_TOKEN_KEY)
+        return self.get_auth_token()
+
     def get_auth_token(self) -> str:
         token = get_from_redis(RESPONSYS_AUTH_TOKEN_KEY)
         if not token:
             data = {
-                "user_name": USERNAME,
-                "password": PASSWORD,
+                "user_name": settings.USERNAME,
+                "password": settings.PASSWORD,
                 "auth_type": "password",
             }
-            response = requests.post(LOGIN_URL, data=data)
+            response = self.request("post", "login", settings.LOGIN_URL, data=data)
             if not self.is_success(response):
                 raise TokenException
             token = response.json()["authToken"]
@@ -64,33 +173,83 @@ class ResponsysParser:
 
     @get_from_redis_or_set
     def get_content(self, module_name: str) -> Optional[str]:
+        return self.request_content(module_name)
+
+    def request_content(self, module_name: str) -> Optional[str]:
+        """Fetches the content of a module from the API, bypassing the cache"""
         headers = {"Authorization": self.token, "Content-Type": "application/json"}
         url = "{base_url}/{module_name}".format(
-            base_url=CONTENT_URL, module_name=module_name
+            base_url=settings.CONTENT_URL, module_name=module_name
         )
-        response = requests.get(url, headers=headers)
+        response = self.request("get", "content", url, headers=headers)
         self.check_response(response)
         content = response.json()["content"]
         return content
 
+    def update_content(self, module_name: str, content: str) -> None:
+        """Replaces the content of a module and its cached copy"""
+        headers = {"Authorization": self.token, "Content-Type": "application/json"}
+        url = "{base_url}/{module_name}".format(
+            base_url=settings.UPDATE_CONTENT_URL, module_name=module_name
+        )
+        response = self.request(
+            "put", "update_content", url, headers=headers, json={"content": content}
+        )
+        self.check_response(response)
+        save_to_redis(module_name, content)
+
+    def get_contents(
+        self,
+        module_names: list,
+        workers: int = FETCH_WORKERS,
+        raw: bool = False,
+        fresh: bool = False,
+    ) -> dict:
+        """Returns {module name: content} for many modules
+
+        The API has no bulk content endpoint, so the cache is checked for all
+        modules in one round trip and only the misses are requested, on
+        workers threads. Failed modules map to None. With raw, cached content
+        is returned as undecoded bytes for the parse_* methods. With fresh,
+        every module is requested and the cache is updated.
+        """
+        contents = dict.fromkeys(module_names)
+        if not fresh:
+            start = time.perf_counter()
+            cached = get_many_from_redis(module_names, decode=not raw)
+            elapsed = (time.perf_counter() - start) / max(len(module_names), 1)
+            for module_name, content in zip(module_names, cached):
+                metrics.record_cache("redis", bool(content), elapsed)
+                contents[module_name] = content
+
+        def request_content(module_name):
+            try:
+                return self.request_content(module_name)
+            except Exception:
+                print("Request failed, continuing...")
+                return None
+
+        misses = [name for name, content in contents.items() if not content]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            fetched = dict(zip(misses, executor.map(request_content, misses)))
+        save_many_to_redis({k: v for k, v in fetched.items() if v is not None})
+        contents.update(fetched)
+        return contents
+
     def get_table(self, folder_name: str, table_name: str):
+        if (folder_name, table_name) in self.table_fields:
+            metrics.record_cache("table_fields", True)
+            return self.table_fields[(folder_name, table_name)]
+        metrics.record_cache("table_fields", False)
+
         headers = {"Authorization": self.token, "Content-Type": "application/json"}
-        url = TABLE_URL.format(folder_name=folder_name, table_name=table_name)
-        response = requests.get(url, headers=headers)
+        url = settings.TABLE_URL.format(folder_name=folder_name, table_name=table_name)
+        response = self.request("get", "table", url, headers=headers)
 
         if self.is_success(response):
-            return response.json()["fields"]
-
-    def build_table_query(self, table_name: str) -> Optional[str]:
-        table_query_dict = self.get_table_query_dict(table_name)
-        if not table_query_dict:
-            return None
-        queries = []
-        for qa, qv in table_query_dict["qav"].items():
-            queries.append("qa={qa}&id={qv}".format(qa=qa, qv=qv))
-        fs = table_query_dict["fs"]
-        queries.append("fs={fs}".format(fs=fs))
-        return "&".join(queries)
+            fields = response.json()["fields"]
+            self.table_fields[(folder_name, table_name)] = fields
+            return fields
 
     def get_table_query_dict(self, table_name: str) -> Optional[dict]:
         try:
@@ -98,31 +257,149 @@ class ResponsysParser:
         except KeyError:
             return None
 
-    def get_table_member(self, table_name: str) -> Optional[dict]:
+    def resolve_lookup_value(self, table_name: str, qa: str) -> Optional[str]:
+        """Returns the id configured for a lookup of the query column qa"""
+        table_query_dict = self.get_table_query_dict(table_name) or {}
+        return table_query_dict.get("qav", {}).get(qa)
+
+    def get_table_members(self, lookups: Iterable[tuple]) -> dict:
+        """Fetches the member records of many (table_name, qa, qv) lookups
+
+        Only lookups with an id configured in TABLES_TO_QUERIES_DICT are
+        fetched. Lookups are deduplicated, so each table and query column is
+        requested once however many variables look it up.
+        """
         headers = {"Authorization": self.token, "Content-Type": "application/json"}
-        query = self.build_table_query(table_name)
-        if not query:
-            return None
 
-        url = TABLE_MEMBERS_URL.format(table_name=table_name, query=query)
-        response = requests.get(url, headers=headers)
+        grouped = {}
+        for table_name, qa, qv in set(lookups):
+            if self.resolve_lookup_value(table_name, qa) is not None:
+                grouped.setdefault((table_name, qa), []).append((table_name, qa, qv))
 
-        if self.is_success(response):
-            return response.json()["recordData"]["records"][0][0]
+        members = {}
+        for (table_name, qa), group in grouped.items():
+            value = self.resolve_lookup_value(table_name, qa)
+            query = "qa={qa}&id={id}&fs={fs},{qa}".format(
+                qa=qa, id=value, fs=self.get_table_query_dict(table_name)["fs"]
+            )
+            url = settings.TABLE_MEMBERS_URL.format(table_name=table_name, query=query)
+            response = self.request("get", "table_members", url, headers=headers)
+            if not self.is_success(response):
+                continue
 
-        return None
+            record_data = response.json()["recordData"]
+            records = [
+                dict(zip(record_data["fieldNames"], record))
+                for record in record_data["records"]
+            ]
+            # Prefer the record of the id when the query column was returned
+            matching = [record for record in records if str(record.get(qa)) == value]
+            if matching or records:
+                for lookup in group:
+                    members[lookup] = (matching or records)[0]
+        return members
 
     def get_contents_of_folder(self, folder_name):
         headers = {"Authorization": self.token, "Content-Type": "application/json"}
 
-        url = LIST_CONTENTS_URL.format(folder_name=folder_name, type="docs")
-        response = requests.get(url, headers=headers)
+        url = settings.LIST_CONTENTS_URL.format(folder_name=folder_name, type="docs")
+        response = self.request("get", "list_contents", url, headers=headers)
 
         if response.status_code == 200:
             documents = response.json()["documents"]
             document_paths = list(map(lambda d: d["documentPath"], documents))
             return document_paths
 
+    def get_folder_listing(self, folder_name: str) -> Optional[tuple]:
+        """Returns (document paths, subfolder names) of a folder"""
+        headers = {"Authorization": self.token, "Content-Type": "application/json"}
+        url = settings.LIST_CONTENTS_URL.format(folder_name=folder_name, type="all")
+        response = self.request("get", "list_contents", url, headers=headers)
+        if response.status_code != 200:
+            return None
+
+        data = response.json()
+        document_paths = [d["documentPath"] for d in data.get("documents") or []]
+        prefix = CONTENT_LIBRARY_WORD + "/"
+        subfolders = []
+        for folder in data.get("folders") or []:
+            folder_path = folder["folderPath"].strip("/")
+            if folder_path.startswith(prefix):
+                folder_path = folder_path[len(prefix) :]
+            subfolders.append(folder_path)
+        return document_paths, subfolders
+
+    def walk_folders(
+        self,
+        folder_names: list,
+        workers: int = FOLDER_WALK_WORKERS,
+        fresh: bool = False,
+    ) -> Iterator[tuple]:
+        """Yields (folder name, document paths) of the folders and all subfolders
+
+        Folders are listed concurrently and yielded as soon as their listing
+        arrives. Complete trees are cached for FOLDER_TREE_TTL_SECONDS. With
+        fresh, the cached trees are not read, but still updated.
+        """
+        roots = []
+        for folder_name in folder_names:
+            if fresh:
+                roots.append(folder_name)
+                continue
+            cached = get_from_redis(FOLDER_TREE_KEY.format(folder_name=folder_name))
+            metrics.record_cache("folder_tree", bool(cached))
+            if cached:
+                yield from json.loads(cached).items()
+            else:
+                roots.append(folder_name)
+        if not roots:
+            return
+
+        tree, failed = {}, set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {
+                executor.submit(self.get_folder_listing, name): name for name in roots
+            }
+            seen = set(roots)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder_name = pending.pop(future)
+                    try:
+                        listing = future.result()
+                    except Exception:
+                        listing = None
+                    if listing is None:
+                        print("Listing {} failed, continuing...".format(folder_name))
+                        failed.add(folder_name)
+                        yield folder_name, None
+                        continue
+
+                    document_paths, subfolders = listing
+                    tree[folder_name] = document_paths
+                    yield folder_name, document_paths
+                    for subfolder in subfolders:
+                        if subfolder not in seen:
+                            seen.add(subfolder)
+                            pending[
+                                executor.submit(self.get_folder_listing, subfolder)
+                            ] = subfolder
+
+        for root in roots:
+            names = [
+                name for name in tree if name == root or name.startswith(root + "/")
+            ]
+            # Incomplete trees are not cached
+            if root not in tree or any(
+                name == root or name.startswith(root + "/") for name in failed
+            ):
+                continue
+            save_to_redis(
+                FOLDER_TREE_KEY.format(folder_name=root),
+                json.dumps({name: tree[name] for name in names}),
+                ex=FOLDER_TREE_TTL_SECONDS,
+            )
+
     def execute(self) -> None:
         if not self.parser_client:
             return None
@@ -132,52 +409,67 @@ class ResponsysParser:
 
 class ResponsysModuleParser(ResponsysParser):
     def __init__(self, module_names=None, **kwargs):
-        super().__init__(self)
+        super().__init__(self, session=kwargs.get("session"), token=kwargs.get("token"))
         self.module_names = module_names
         self.depth = 1
-        self.find_containing_modules = kwargs["find_containing_modules"]
-        self.find_tables = kwargs["find_tables"]
-        self.print_content = kwargs["print_content"]
-
-    def has_containing_modules(self, content: str) -> bool:
-        return CONTENT_LIBRARY_WORD in content
-
-    def build_module_regex_from_content(self, content: str) -> str:
-        initial_regex = r"^.*{cgs}$"
-        word_count = content.count(CONTENT_LIBRARY_WORD)
-        final_regex = initial_regex.format(cgs=word_count * CONTENT_LIBRARY_REGEX)
-        return final_regex
-
-    def parse_module(self, content: str) -> Optional[list]:
+        self.find_containing_modules = kwargs.get("find_containing_modules", False)
+        self.find_tables = kwargs.get("find_tables", False)
+        self.print_content = kwargs.get("print_content", False)
+        self.keep_content = kwargs.get("keep_content", KEEP_CONTENT)
+        # None parses every content again
+        self.parse_cache = kwargs.get("parse_cache", parse_cache)
+
+    def has_containing_modules(self, content: Content) -> bool:
+        return as_content_type(CONTENT_LIBRARY_WORD, content) in content
+
+    def parse_module(self, content: Content) -> Optional[list]:
+        """Returns the contentlibrary paths included by str or bytes content
+
+        Every path runs from a contentlibrary word to the last .htm before the
+        next one, nothing is found if one of them has no .htm. Paths are
+        returned unicode escaped, only they are decoded, not the whole content.
+        """
         if not self.has_containing_modules(content):
             return None
 
-        use_regex = self.build_module_regex_from_content(content)
-        modules = []
+        word = as_content_type(CONTENT_LIBRARY_WORD, content)
+        extension = as_content_type(CONTENT_LIBRARY_EXTENSION, content)
+        starts = []
+        start = content.find(word)
+        while start != -1:
+            starts.append(start)
+            start = content.find(word, start + len(word))
 
-        # unicode escape
-        content = content.encode("unicode_escape").decode("utf-8")
-
-        matches = re.finditer(use_regex, content, re.MULTILINE)
-
-        for _, match in enumerate(matches, start=1):
-            for group_num in range(0, len(match.groups())):
-                group_num = group_num + 1
-                modules.append(match.group(group_num))
+        modules = []
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else len(content)
+            extension_pos = content.rfind(extension, start + len(word), end)
+            if extension_pos == -1:
+                return []
+            module = content[start : extension_pos + len(extension)]
+            if isinstance(module, bytes):
+                module = module.decode("utf-8")
+            modules.append(module.encode("unicode_escape").decode("utf-8"))
         return modules
 
     @staticmethod
-    def parse_queries(content: str):
+    def parse_queries(content: Content) -> list:
         """Parses for Responsys queries in the given HTML content"""
-        result = re.findall(QUERY_REGEX, content)
+        result = compile_regex(QUERY_REGEX, content).findall(content)
+        if isinstance(content, bytes):
+            result = [query.decode("utf-8") for query in result]
         return result
 
     @staticmethod
-    def parse_table_information(query: str) -> list:
+    def parse_table_information(query: Content) -> list:
         """Tries to parse a table from the passed in Responsys query"""
         matches = []
-        for match in re.finditer(TABLE_REGEX, query, re.IGNORECASE):
-            group_dict = match.groupdict()
+        table_regex = compile_regex(TABLE_REGEX, query, re.IGNORECASE)
+        for match in table_regex.finditer(query):
+            group_dict = {
+                key: value.decode("utf-8") if isinstance(value, bytes) else value
+                for key, value in match.groupdict().items()
+            }
             folder_name = group_dict["folder_name"]
             table_name = group_dict["table_name"]
             qa = group_dict["qa"] if group_dict["qa"] != "LANG" else group_dict["qa2"]
@@ -188,6 +480,7 @@ class ResponsysModuleParser(ResponsysParser):
                 "table_name": table_name,
                 "qa": qa,
                 "qv": qv,
+                "offset": match.start("table_name"),
             }
             matches.append(data)
         return matches
@@ -202,47 +495,94 @@ class ResponsysModuleParser(ResponsysParser):
         second = module_name[comma_pos + 1 :]
         return "{}/{}".format(first.strip(), second.strip())
 
-    def parse_table(self, queries: list) -> dict:
-        data = {}
-        for query in queries:
-            table_informations = self.parse_table_information(query)
-            if table_informations:
-                for table_information in table_informations:
-                    folder_name, table_name, qa, qv = (
-                        table_information["folder_name"],
-                        table_information["table_name"],
-                        table_information["qa"],
-                        table_information["qv"],
-                    )
-
-                    if all((folder_name, table_name)):
-                        fields = self.get_table(folder_name, table_name)
-                        data["TABLE-{}".format(table_name)] = fields
-
-                    if all((qa, qv)):
-                        member_result = self.get_table_member(table_name)
-                        if member_result:
-                            data["MEMBER-{}".format(qv)] = member_result
-        return data
+    def extract_content(self, content: Content) -> ParsedContent:
+        """Returns the includes, queries and table references of content
+
+        Results are cached by content hash, so identical content is only
+        parsed once.
+        """
+        key = self.parse_cache.key(content) if self.parse_cache else None
+        parsed = self.parse_cache.get(key) if key else None
+        if parsed:
+            return parsed
+
+        with metrics.stage("include_extraction"):
+            includes = self.parse_module(content)
+        with metrics.stage("query_extraction"):
+            queries = self.parse_queries(content)
+        with metrics.stage("table_parsing"):
+            tables = [
+                (
+                    table_information["folder_name"],
+                    table_information["table_name"],
+                    table_information["qa"],
+                    table_information["qv"],
+                    table_information["offset"],
+                )
+                for query in queries
+                for table_information in self.parse_table_information(query)
+            ]
+        parsed = ParsedContent(includes, queries, tables)
+        if key:
+            self.parse_cache.set(key, parsed)
+        return parsed
+
+    def parse_table(self, table_references: list) -> dict:
+        """Returns {table name: fields}, members are fetched by attach_table_members"""
+        tables = {}
+        for folder_name, table_name, _, _, _ in table_references:
+            if all((folder_name, table_name)):
+                tables[table_name] = self.get_table(folder_name, table_name)
+        return tables
 
-    def parse_content(self, module_name: str, depth: int = 1):
-        """Parses all the content and return all the Responsys Queries"""
+    @staticmethod
+    def collect_table_lookups(table_references: list) -> list:
+        return [
+            (table_name, qa, qv)
+            for _, table_name, qa, qv, _ in table_references
+            if all((table_name, qa, qv))
+        ]
 
-        list_of_queries = []
+    def attach_table_members(self, list_of_queries: list) -> None:
+        """Fetches the members of every parsed module, each lookup once"""
+        members = self.get_table_members(
+            lookup for result in list_of_queries for lookup in result.lookups
+        )
+        for result in list_of_queries:
+            for table_name, qa, qv in result.lookups:
+                member = members.get((table_name, qa, qv))
+                if member:
+                    result.members[qv] = member
 
+    def fetch_content(self, module_name: str) -> Optional[str]:
         try:
-            content = self.get_content(module_name)
+            return self.get_content(module_name)
         except Exception:
             print("Request failed, continuing...")
-            content = None
+            return None
+
+    def parse_content(
+        self, module_name: str, depth: int = 1, content: Optional[Content] = None
+    ) -> List[ModuleResult]:
+        """Parses all the content and return all the Responsys Queries
+
+        The content of module_name is fetched unless it is passed in. Unless
+        keep_content is set, results reload their content when it is read.
+        """
+
+        list_of_queries = []
+
+        if content is None:
+            content = self.fetch_content(module_name)
 
         if not content:
             print("No content found for module: {}".format(module_name))
             return list_of_queries
 
+        parsed = self.extract_content(content)
         module_paths = None
         if self.find_containing_modules and depth != FIND_CONTAINING_MODULES_DEPTH:
-            content_module_names = self.parse_module(content)
+            content_module_names = parsed.includes
 
             if content_module_names:
                 module_paths = [
@@ -254,67 +594,1135 @@ class ResponsysModuleParser(ResponsysParser):
                 for module_path in module_paths:
                     list_of_queries.extend(self.parse_content(module_path, depth=depth))
 
-        queries = self.parse_queries(content)
-        data = {
-            "module_name": module_name,
-            "queries": queries,
-            "content": content,
-            "called_modules": module_paths,
-        }
+        result = ModuleResult(
+            module_name, parsed.queries, content=content, called_modules=module_paths
+        )
+        if not self.keep_content:
+            result.drop_content(self.fetch_content)
 
         if self.find_tables:
-            table_data = self.parse_table(queries)
-            data = {**data, **table_data}
+            result.tables = self.parse_table(parsed.tables)
+            result.lookups = self.collect_table_lookups(parsed.tables)
 
-        list_of_queries.append(data)
+        list_of_queries.append(result)
 
         return list_of_queries
 
-    def execute(self):
-        for module_name in self.module_names:
+    def parse_modules(self) -> List[List[ModuleResult]]:
+        """Parses every module, returns the results of each with its includes"""
+        results = [
+            self.parse_content(module_name, self.depth)
+            for module_name in self.module_names
+        ]
+        if self.find_tables:
+            self.attach_table_members(
+                [data for list_of_queries in results for data in list_of_queries]
+            )
+        return results
+
+    def iter_parse(
+        self,
+        module_names: Optional[list] = None,
+        workers: int = FETCH_WORKERS,
+        buffer_size: int = PIPELINE_QUEUE_SIZE,
+    ) -> Iterator[List[ModuleResult]]:
+        """Yields the results of every module, with its includes, as it completes
+
+        Modules are parsed on workers threads and at most buffer_size results
+        are held for the consumer. Closing the generator cancels the rest.
+        """
+
+        def parse(module_name):
             list_of_queries = self.parse_content(module_name, self.depth)
-            dump_list(list_of_queries, self.print_content)
+            if self.find_tables:
+                self.attach_table_members(list_of_queries)
+            return list_of_queries
+
+        pipeline = Pipeline([Stage("parse", parse, workers=workers)], buffer_size)
+        yield from pipeline.iter(module_names or self.module_names)
+
+    def execute(self):
+        for list_of_queries in self.parse_modules():
+            with metrics.stage("report_writing"):
+                dump_list(list_of_queries, self.print_content)
         print("Finished parsing {module_names}".format(module_names=self.module_names))
 
 
 class ResponsysFolderScanner(ResponsysModuleParser):
-    def __init__(self, keyword, folder_names):
+    def __init__(
+        self,
+        keyword,
+        folder_names,
+        fetch_workers=FETCH_WORKERS,
+        parse_workers=PARSE_WORKERS,
+        recursive=False,
+        resume=False,
+        checkpoint_path=None,
+        **kwargs,
+    ):
         super().__init__(
-            self, find_containing_modules=False, print_content=False, find_tables=False
+            self,
+            find_containing_modules=False,
+            print_content=False,
+            find_tables=False,
+            **kwargs,
         )
         self.keyword = keyword
         self.folder_names = folder_names
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.recursive = recursive
+        self.resume = resume
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = None
+
+    def load_checkpoint(self, keyword, folder_names) -> ScanCheckpoint:
+        """Returns the checkpoint to resume from, or a new one"""
+        path = self.checkpoint_path or CHECKPOINT_FILE_PATH.format(
+            keyword=keyword.replace("/", "-")
+        )
+        checkpoint = ScanCheckpoint.load(path) if self.resume else None
+        if checkpoint and not checkpoint.is_compatible(keyword, folder_names):
+            print("Checkpoint {} is for another scan, starting over".format(path))
+            checkpoint = None
+        if checkpoint:
+            print(
+                "Resuming, {} modules were already scanned".format(
+                    len(checkpoint.completed)
+                )
+            )
+            return checkpoint
+        return ScanCheckpoint(path, keyword, folder_names)
+
+    def iter_folders(self, folder_names) -> Iterator[tuple]:
+        """Yields (folder name, module names), walking subfolders if recursive"""
+        if self.recursive:
+            yield from self.walk_folders(folder_names)
+            return
+        for folder_name in folder_names:
+            yield folder_name, self.get_contents_of_folder(folder_name)
+
+    def list_folder(self, item: tuple) -> Optional[list]:
+        folder_name, module_names = item
+        print("Scanning {folder_name} now...".format(folder_name=folder_name))
+        print(100 * "*")
+        self.scanned_folders[folder_name] = bool(module_names)
+        if not module_names:
+            print("No module names found!")
+            return None
+        items = [
+            (folder_name, module_index, module_name)
+            for module_index, module_name in enumerate(module_names)
+            if not self.checkpoint or module_name not in self.checkpoint.completed
+        ]
+        return [
+            items[start : start + BULK_FETCH_SIZE]
+            for start in range(0, len(items), BULK_FETCH_SIZE)
+        ]
 
-    def scan_folder_for_keyword(self, keyword, folder_names):
-        module_names_string = ""
+    def fetch_modules(self, items: list) -> list:
+        """Fetches a batch of modules with one cache round trip"""
+        contents = self.get_contents([item[2] for item in items], workers=1, raw=True)
+        fetched = []
+        for item in items:
+            content = contents[item[2]]
+            if not content:
+                print("No content found for module: {}".format(item[2]))
+                print("No query found!")
+                continue
+            fetched.append(item + (content,))
+        return fetched
+
+    def parse_module_queries(self, item: tuple) -> Optional[tuple]:
+        folder_name, module_index, module_name, content = item
+        list_of_queries = self.parse_content(module_name, depth=1, content=content)
+        if not list_of_queries:
+            print("No query found!")
+            if self.checkpoint:
+                self.checkpoint.mark_completed(module_name)
+            return None
+        return folder_name, module_index, module_name, list_of_queries[0].queries
+
+    def match_keyword(self, item: tuple) -> None:
+        folder_name, module_index, module_name, queries = item
+        match = None
+        for query in queries:
+            if self.keyword in query:
+                print(100 * "-")
+                print(module_name)
+                print(100 * "-")
+                match = (folder_name, module_index, module_name)
+                self.matches.append(match)
+                break
+        if self.checkpoint:
+            self.checkpoint.mark_completed(module_name, match)
+
+    def match_keywords(self, item: tuple) -> Optional[ScanMatch]:
+        folder_name, _, module_name, queries = item
+        keywords = [
+            keyword
+            for keyword in self.keywords
+            if any(keyword in query for query in queries)
+        ]
+        if keywords:
+            return ScanMatch(folder_name, module_name, keywords)
+        return None
+
+    def iter_scan(
+        self,
+        folder_names: Optional[list] = None,
+        keywords: Optional[list] = None,
+        buffer_size: int = PIPELINE_QUEUE_SIZE,
+    ) -> Iterator[ScanMatch]:
+        """Yields a ScanMatch for every module matching any keyword
+
+        Matches are yielded as modules complete, without checkpoints or report
+        files, and at most buffer_size are held for the consumer. Closing the
+        generator cancels the scan.
+        """
+        self.keywords = keywords or [self.keyword]
+        self.checkpoint = None
+        self.scanned_folders = {}
+        pipeline = Pipeline(
+            [
+                Stage("list", self.list_folder, many=True),
+                Stage(
+                    "fetch", self.fetch_modules, workers=self.fetch_workers, many=True
+                ),
+                Stage("parse", self.parse_module_queries, workers=self.parse_workers),
+                Stage("match", self.match_keywords),
+            ],
+            buffer_size,
+        )
+        yield from pipeline.iter(self.iter_folders(folder_names or self.folder_names))
+
+    def report_folders(self, folder_names) -> list:
+        """Returns the scanned folders, subfolders sorted after their root"""
+        report_folders = []
         for folder_name in folder_names:
+            report_folders.append(folder_name)
+            report_folders.extend(
+                sorted(
+                    name
+                    for name in self.scanned_folders
+                    if name.startswith(folder_name + "/")
+                )
+            )
+        return report_folders
+
+    def scan_folder_for_keyword(self, keyword, folder_names, write_report=True):
+        """Scans the folders in a list -> fetch -> parse -> match pipeline
+
+        Returns the (folder name, module index, module name) matches.
+        """
+        self.keyword = keyword
+        self.checkpoint = self.load_checkpoint(keyword, folder_names)
+        self.matches = list(self.checkpoint.matches)
+        self.scanned_folders = {}
+        pipeline = Pipeline(
+            [
+                Stage("list", self.list_folder, many=True),
+                Stage(
+                    "fetch", self.fetch_modules, workers=self.fetch_workers, many=True
+                ),
+                Stage("parse", self.parse_module_queries, workers=self.parse_workers),
+                Stage("match", self.match_keyword),
+            ]
+        )
+        try:
+            pipeline.run(self.iter_folders(folder_names))
+        finally:
+            self.checkpoint.save()
+
+        if write_report:
+            self.write_scan_report(keyword, folder_names)
+        self.checkpoint.remove()
+        return sorted(self.matches)
+
+    def write_scan_report(self, keyword, folder_names) -> None:
+        module_names_string = ""
+        for folder_name in self.report_folders(folder_names):
             module_names_string += "--- " + folder_name + " ---" + "\n\n\n\n"
-            print("Scanning {folder_name} now...".format(folder_name=folder_name))
-            print(100 * "*")
-            module_names = self.get_contents_of_folder(folder_name)
-            if not module_names:
-                print("No module names found!")
+            if not self.scanned_folders.get(folder_name):
                 continue
-            for module_name in module_names:
-                list_of_queries = self.parse_content(module_name, depth=1)
-                if not list_of_queries:
-                    print("No query found!")
-                    continue
-                queries = list_of_queries[0]["queries"]
-                for query in queries:
-                    if keyword in query:
-                        print(100 * "-")
-                        print(module_name)
-                        module_names_string += module_name + "\n\n"
-                        print(100 * "-")
-                        break
+            for match in sorted(self.matches):
+                if match[0] == folder_name:
+                    module_names_string += match[2] + "\n\n"
             module_names_string += "\n\n"
-        write_queries_to_file(keyword, module_names_string)
+        with metrics.stage("report_writing"):
+            write_queries_to_file(keyword, module_names_string)
 
     def execute(self):
         self.scan_folder_for_keyword(self.keyword, self.folder_names)
 
 
+class ResponsysScanWorker(ResponsysFolderScanner):
+    """Scans the modules a coordinator enqueued for scan_id in Redis
+
+    Workers on any host share the auth token and content cache in Redis, and
+    run until every module of the scan is done.
+    """
+
+    def __init__(
+        self,
+        scan_id,
+        threads=FETCH_WORKERS,
+        batch_size=BULK_FETCH_SIZE,
+        lease_seconds=SCAN_LEASE_SECONDS,
+        poll_seconds=SCAN_POLL_SECONDS,
+        **kwargs,
+    ):
+        self.queue = ScanQueue(scan_id)
+        info = self.queue.info()
+        if info is None:
+            raise ValueError("Unknown scan: {}".format(scan_id))
+        super().__init__(
+            keyword=info["keyword"], folder_names=info["folder_names"], **kwargs
+        )
+        self.scan_id = scan_id
+        self.threads = threads
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.scanned = 0
+
+    def scan_batch(self, items: list) -> None:
+        matches = {}
+        for item in self.fetch_modules(items):
+            parsed = self.parse_module_queries(item)
+            matches[item[:3]] = bool(parsed) and any(
+                self.keyword in query for query in parsed[3]
+            )
+        self.queue.complete(matches)
+        # Modules whose content could not be fetched are tried again
+        self.queue.retry([item for item in items if item not in matches])
+        with self.lock:
+            self.scanned += len(matches)
+
+    def work(self) -> None:
+        while True:
+            items = self.queue.claim(self.batch_size, self.lease_seconds)
+            if not items:
+                if self.queue.is_finished():
+                    return
+                time.sleep(self.poll_seconds)
+                continue
+            try:
+                self.scan_batch(items)
+            except Exception as e:
+                print("Scanning a batch failed: {!r}".format(e))
+                self.queue.retry(items)
+
+    def execute(self):
+        with ThreadPoolExecutor(max_workers=max(self.threads, 1)) as executor:
+            for future in [executor.submit(self.work) for _ in range(self.threads)]:
+                future.result()
+        print(
+            "Scanned {count} modules of {scan_id}".format(
+                count=self.scanned, scan_id=self.scan_id
+            )
+        )
+
+
+class ResponsysScanCoordinator(ResponsysFolderScanner):
+    """Enqueues the modules of the folders for ResponsysScanWorkers in Redis
+
+    Waits until the workers are done and writes the scan report. With resume,
+    the modules still pending of an earlier scan of scan_id are waited for
+    instead of listing the folders again.
+    """
+
+    def __init__(
+        self,
+        keyword,
+        folder_names,
+        scan_id=None,
+        local_workers=0,
+        poll_seconds=SCAN_POLL_SECONDS,
+        **kwargs,
+    ):
+        super().__init__(keyword=keyword, folder_names=folder_names, **kwargs)
+        self.scan_id = scan_id or keyword.replace("/", "-")
+        self.queue = ScanQueue(self.scan_id)
+        self.local_workers = local_workers
+        self.poll_seconds = poll_seconds
+
+    def enqueue_folders(self) -> None:
+        self.queue.create(self.keyword, self.folder_names)
+        for folder_name, module_names in self.iter_folders(self.folder_names):
+            if not module_names:
+                print("No module names found in {}!".format(folder_name))
+            self.queue.enqueue(folder_name, module_names or [])
+        self.queue.mark_listed()
+
+    def wait(self) -> None:
+        while not self.queue.is_finished():
+            time.sleep(self.poll_seconds)
+            print("{done}/{total} modules done".format(**self.queue.progress()))
+
+    def run_local_workers(self, executor: ThreadPoolExecutor) -> list:
+        def work():
+            ResponsysScanWorker(
+                self.scan_id,
+                threads=1,
+                poll_seconds=self.poll_seconds,
+                session=self.session,
+                token=self.token,
+            ).execute()
+
+        return [executor.submit(work) for _ in range(self.local_workers)]
+
+    def scan_folder_for_keyword(self, keyword, folder_names, write_report=True):
+        """Scans the folders on workers, returns the matches like a local scan"""
+        self.keyword = keyword
+        self.folder_names = folder_names
+        info = self.queue.info()
+        # Scans interrupted while listing the folders are started over
+        resume = self.resume and info and info["keyword"] == keyword and info["listed"]
+        with ThreadPoolExecutor(max_workers=max(self.local_workers, 1)) as executor:
+            if not resume:
+                self.enqueue_folders()
+            print(
+                "Enqueued {total} modules as scan {scan_id}".format(
+                    total=self.queue.progress()["total"], scan_id=self.scan_id
+                )
+            )
+            futures = self.run_local_workers(executor)
+            self.wait()
+            for future in futures:
+                future.result()
+
+        results = self.queue.results()
+        self.matches = [item for item, result in results.items() if result == MATCH]
+        failed = sorted(
+            item[2] for item, result in results.items() if result == SCAN_FAILED
+        )
+        for module_name in failed:
+            print("Scanning {} failed".format(module_name))
+        self.scanned_folders = {
+            folder_name: bool(count)
+            for folder_name, count in self.queue.folders().items()
+        }
+        if write_report:
+            self.write_scan_report(keyword, folder_names)
+        self.queue.delete()
+        return sorted(self.matches)
+
+
+class ResponsysContentIndexer(ResponsysModuleParser):
+    def __init__(
+        self,
+        folder_names,
+        index_path=INDEX_FILE_PATH,
+        fetch_workers=FETCH_WORKERS,
+        parse_workers=PARSE_WORKERS,
+        **kwargs,
+    ):
+        super().__init__(
+            find_containing_modules=False,
+            print_content=False,
+            find_tables=False,
+            **kwargs,
+        )
+        self.folder_names = folder_names
+        self.index_path = index_path
+        self.index = ContentIndex.load(index_path)
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.updated = 0
+
+    def extract_index_terms(self, content: str) -> list:
+        """Returns (kind, term, offset) for every variable, function and table"""
+        occurrences = []
+        for query_match in re.finditer(QUERY_REGEX, content):
+            query, start = query_match.group(1), query_match.start(1)
+            for match in re.finditer(VARIABLE_REGEX, query):
+                occurrences.append(
+                    ("variable", match.group("name"), start + match.start("name"))
+                )
+            for match in re.finditer(FUNCTION_REGEX, query):
+                occurrences.append(
+                    ("function", match.group("name"), start + match.start("name"))
+                )
+            for table_information in self.parse_table_information(query):
+                occurrences.append(
+                    (
+                        "table",
+                        table_information["table_name"],
+                        start + table_information["offset"],
+                    )
+                )
+        return occurrences
+
+    def extract_module(self, item: tuple) -> Optional[tuple]:
+        """Returns the index terms of a module, None if it did not change"""
+        module_name, content = item
+        content_hash = hash_content(content)
+        if self.index.is_current(module_name, content_hash):
+            return None
+        return module_name, content_hash, self.extract_index_terms(content)
+
+    def fetch_module(self, module_name: str) -> Optional[tuple]:
+        """Fetches a module, bypassing the cache which may be stale"""
+        content = self.get_contents([module_name], workers=1, fresh=True)[module_name]
+        if not content:
+            print("No content found for module: {}".format(module_name))
+            return None
+        return module_name, content
+
+    def write_module(self, item: tuple) -> None:
+        self.index.add_module(*item)
+        self.updated += 1
+
+    def index_module(self, module_name: str) -> bool:
+        """Indexes a module, returns False if it was skipped"""
+        item = self.fetch_module(module_name)
+        item = item and self.extract_module(item)
+        if not item:
+            return False
+        self.write_module(item)
+        return True
+
+    def index_folders(self, folder_names) -> None:
+        all_module_names = []
+        for folder_name in folder_names:
+            print("Indexing {folder_name} now...".format(folder_name=folder_name))
+            module_names = self.get_contents_of_folder(folder_name)
+            if module_names is None:
+                print("No module names found!")
+                continue
+
+            # Drop modules which no longer exist in the folder, but not those
+            # of its subfolders
+            folder_path = "/{}/{}".format(CONTENT_LIBRARY_WORD, folder_name.strip("/"))
+            for module_name in list(self.index.modules):
+                if module_name.rsplit("/", 1)[0] == folder_path and (
+                    module_name not in module_names
+                ):
+                    self.index.remove_module(module_name)
+            all_module_names.extend(module_names)
+
+        # The index is only written by the single write worker
+        self.updated = 0
+        pipeline = Pipeline(
+            [
+                Stage("fetch", self.fetch_module, workers=self.fetch_workers),
+                Stage("extract", self.extract_module, workers=self.parse_workers),
+                Stage("write", self.write_module),
+            ]
+        )
+        pipeline.run(all_module_names)
+        print(
+            "Updated {updated} of {total} modules".format(
+                updated=self.updated, total=len(all_module_names)
+            )
+        )
+        self.index.save(self.index_path)
+
+    def execute(self):
+        self.index_folders(self.folder_names)
+
+
+class ResponsysLibrarySnapshotter(ResponsysModuleParser):
+    """Snapshots the library, parsing only modules changed since base_path"""
+
+    def __init__(
+        self,
+        folder_names,
+        snapshot_path,
+        base_path=None,
+        report_path=DIFF_FILE_PATH,
+        recursive=False,
+        fetch_workers=FETCH_WORKERS,
+        parse_workers=PARSE_WORKERS,
+        **kwargs,
+    ):
+        super().__init__(
+            find_containing_modules=True,
+            print_content=False,
+            find_tables=False,
+            **kwargs,
+        )
+        self.base = LibrarySnapshot.load(base_path) if base_path else None
+        self.folder_names = folder_names or (
+            self.base.folder_names if self.base else FOLDER_NAMES
+        )
+        self.snapshot_path = snapshot_path
+        self.report_path = report_path
+        self.recursive = recursive
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.lock = threading.Lock()
+        self.parsed = 0
+
+    def iter_module_batches(self) -> Iterator[list]:
+        if self.recursive:
+            # A cached tree may be missing added and removed modules
+            listings = self.walk_folders(self.folder_names, fresh=True)
+        else:
+            listings = (
+                (folder_name, self.get_contents_of_folder(folder_name))
+                for folder_name in self.folder_names
+            )
+        for folder_name, module_names in listings:
+            if not module_names:
+                print("No module names found in {}!".format(folder_name))
+                continue
+            for start in range(0, len(module_names), BULK_FETCH_SIZE):
+                yield module_names[start : start + BULK_FETCH_SIZE]
+
+    def fetch_modules(self, module_names: list) -> list:
+        """Fetches a batch of modules, bypassing the cache which may be stale"""
+        contents = self.get_contents(module_names, workers=1, fresh=True)
+        for module_name, content in contents.items():
+            if not content:
+                print("No content found for module: {}".format(module_name))
+        return [item for item in contents.items() if item[1]]
+
+    def snapshot_module(self, item: tuple) -> None:
+        """Adds a module, reusing the base snapshot's results if it is unchanged"""
+        module_name, content = item
+        content_hash = hash_content(content)
+        if self.base and self.base.is_current(module_name, content_hash):
+            module = self.base.modules[module_name]
+            includes, queries, tables = (
+                module["includes"],
+                module["queries"],
+                module["tables"],
+            )
+        else:
+            parsed = self.extract_content(content)
+            includes = [
+                "/" + self.build_module_path(include)
+                for include in parsed.includes or []
+            ]
+            queries = parsed.queries
+            tables = [table_reference[1] for table_reference in parsed.tables]
+            with self.lock:
+                self.parsed += 1
+        with self.lock:
+            self.snapshot.add_module(
+                module_name, content_hash, includes, queries, tables
+            )
+
+    def take_snapshot(self) -> LibrarySnapshot:
+        self.snapshot = LibrarySnapshot(self.folder_names)
+        self.parsed = 0
+        pipeline = Pipeline(
+            [
+                Stage(
+                    "fetch_modules",
+                    self.fetch_modules,
+                    workers=self.fetch_workers,
+                    many=True,
+                ),
+                Stage("snapshot", self.snapshot_module, workers=self.parse_workers),
+            ]
+        )
+        pipeline.run(self.iter_module_batches())
+        return self.snapshot
+
+    def execute(self):
+        snapshot = self.take_snapshot()
+        snapshot.save(self.snapshot_path)
+        print(
+            "Saved {total} modules to {path}, parsed {parsed} of them".format(
+                total=len(snapshot.modules), path=self.snapshot_path, parsed=self.parsed
+            )
+        )
+        if self.base:
+            report_diff(self.base, snapshot, self.report_path)
+
+
+class ResponsysTemplateExpander(ResponsysModuleParser):
+    """Writes modules with all their includes inlined"""
+
+    def __init__(self, module_names, output_path=EXPANDED_FILE_PATH, **kwargs):
+        super().__init__(
+            module_names=module_names,
+            find_containing_modules=False,
+            print_content=False,
+            find_tables=False,
+            **kwargs,
+        )
+        self.output_path = output_path
+        self.expander = TemplateExpander(self.fetch_content)
+
+    def execute(self):
+        for module_name in self.module_names:
+            expanded = self.expander.expand(module_name)
+            if expanded is None:
+                print("No content found for module: {}".format(module_name))
+                continue
+            path = self.output_path.format(
+                module_name=module_name.strip("/").replace("/", "-")
+            )
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as file:
+                file.write(expanded)
+            print(
+                "Expanded {module_name} to {path} ({size} bytes)".format(
+                    module_name=module_name,
+                    path=path,
+                    size=len(expanded.encode("utf-8")),
+                )
+            )
+
+
+class ResponsysContentUpdater(ResponsysFolderScanner):
+    """Finds and replaces in the modules matching the keywords, or module_names
+
+    Edits are written as a diff to report_path and only pushed with apply.
+    Before a module is updated its content is fetched again, and modules
+    changed since the edit was planned are skipped as conflicts.
+    """
+
+    def __init__(
+        self,
+        replacements: List[Replacement],
+        module_names=None,
+        keywords=None,
+        folder_names=FOLDER_NAMES,
+        apply=False,
+        update_workers=UPDATE_WORKERS,
+        rate=UPDATE_RATE_PER_SECOND,
+        report_path=UPDATE_DIFF_FILE_PATH,
+        **kwargs,
+    ):
+        # Literal replacements are found by scanning for their old text
+        keywords = keywords or [
+            replacement.old for replacement in replacements if not replacement.regex
+        ]
+        super().__init__(
+            keyword=keywords[0] if keywords else None,
+            folder_names=folder_names,
+            **kwargs,
+        )
+        if not module_names and not keywords:
+            raise ValueError("Regex replacements need module names or keywords")
+        self.replacements = replacements
+        self.update_module_names = module_names
+        self.keywords = keywords
+        self.apply = apply
+        self.update_workers = update_workers
+        self.rate_limiter = RateLimiter(rate)
+        self.report_path = report_path
+
+    def find_modules(self) -> list:
+        if self.update_module_names:
+            return list(self.update_module_names)
+        return sorted(
+            match.module_name
+            for match in self.iter_scan(self.folder_names, self.keywords)
+        )
+
+    def plan_updates(self, module_names: list) -> List[ContentUpdate]:
+        """Returns the edits of the modules, planned from their current content"""
+        contents = self.get_contents(
+            module_names, workers=self.update_workers, fresh=True
+        )
+        updates = []
+        for module_name in module_names:
+            if not contents[module_name]:
+                print("No content found for module: {}".format(module_name))
+                continue
+            update = plan_update(module_name, contents[module_name], self.replacements)
+            if update:
+                updates.append(update)
+        return updates
+
+    def push_update(self, update: ContentUpdate) -> str:
+        try:
+            self.rate_limiter.wait()
+            current = self.request_content(update.module_name)
+            if hash_content(current) != hash_content(update.original):
+                print("{} changed since it was fetched".format(update.module_name))
+                # The cached copy may be as stale as the planned edit
+                save_to_redis(update.module_name, current)
+                return CONFLICT
+            self.rate_limiter.wait()
+            self.update_content(update.module_name, update.updated)
+        except Exception as e:
+            print("Updating {} failed: {!r}".format(update.module_name, e))
+            return FAILED
+        return UPDATED
+
+    def push_updates(self, updates: List[ContentUpdate]) -> Dict[str, str]:
+        """Returns {module name: outcome} of pushing the edits concurrently"""
+        with ThreadPoolExecutor(max_workers=max(self.update_workers, 1)) as executor:
+            outcomes = executor.map(self.push_update, updates)
+            return {
+                update.module_name: outcome
+                for update, outcome in zip(updates, outcomes)
+            }
+
+    def write_report(self, updates: List[ContentUpdate], outcomes=None) -> None:
+        os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+        with open(self.report_path, "w") as file:
+            file.write(format_updates(updates, outcomes))
+
+    def execute(self) -> Optional[Dict[str, str]]:
+        updates = self.plan_updates(self.find_modules())
+        self.write_report(updates)
+        print(
+            "{count} modules to update, diff written to {path}".format(
+                count=len(updates), path=self.report_path
+            )
+        )
+        if not self.apply or not updates:
+            if updates:
+                print("Dry run, nothing was updated")
+            return None
+
+        outcomes = self.push_updates(updates)
+        self.write_report(updates, outcomes)
+        print(
+            ", ".join(
+                "{} {}".format(list(outcomes.values()).count(outcome), outcome)
+                for outcome in (UPDATED, CONFLICT, FAILED)
+            )
+        )
+        return outcomes
+
+
+def report_diff(
+    old: LibrarySnapshot, new: LibrarySnapshot, report_path=DIFF_FILE_PATH
+) -> dict:
+    """Prints the changes between two snapshots and writes them to report_path"""
+    diff = diff_snapshots(old, new)
+    report = format_diff(diff)
+    print(report)
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    with open(report_path, "w") as file:
+        file.write(report)
+    return diff
+
+
+def lookup_index(term: str, kind: Optional[str] = None, index_path=INDEX_FILE_PATH):
+    index = ContentIndex.load(index_path)
+    result = index.lookup(term, kind)
+    if not result:
+        print("No module found for {term}".format(term=term))
+    for module_name, offsets in sorted(result.items()):
+        print(
+            "{module_name}: {offsets}".format(module_name=module_name, offsets=offsets)
+        )
+    return result
+
+
+def build_module_list(input_modules: list, folder_name: str) -> list:
+    return [
+        "/contentlibrary/{folder_name}/{input_module}.htm".format(
+            folder_name=folder_name, input_module=input_module
+        )
+        for input_module in input_modules
+    ]
+
+
+def build_job_client(job: dict, **kwargs) -> ResponsysParser:
+    """Returns the parser client of a job dict, kwargs are passed to the client"""
+    command = job["command"]
+    if command == "parse":
+        return ResponsysModuleParser(
+            module_names=build_module_list(
+                job["modules"], job.get("folder", FOLDER_NAMES[0])
+            ),
+            find_containing_modules=job.get("find_containing_modules", False),
+            find_tables=job.get("find_tables", False),
+            print_content=job.get("print_content", False),
+            keep_content=job.get("keep_content", KEEP_CONTENT),
+            **kwargs,
+        )
+    elif command == "scan" and job.get("distributed"):
+        return ResponsysScanCoordinator(
+            keyword=job.get("keyword", SCAN_KEYWORD),
+            folder_names=job.get("folders", FOLDER_NAMES),
+            scan_id=job.get("scan_id"),
+            local_workers=job.get("local_workers", 0),
+            recursive=job.get("recursive", False),
+            resume=job.get("resume", False),
+            **kwargs,
+        )
+    elif command == "scan":
+        return ResponsysFolderScanner(
+            keyword=job.get("keyword", SCAN_KEYWORD),
+            folder_names=job.get("folders", FOLDER_NAMES),
+            fetch_workers=job.get("fetch_workers", FETCH_WORKERS),
+            parse_workers=job.get("parse_workers", PARSE_WORKERS),
+            recursive=job.get("recursive", False),
+            resume=job.get("resume", False),
+            checkpoint_path=job.get("checkpoint"),
+            **kwargs,
+        )
+    elif command == "worker":
+        return ResponsysScanWorker(
+            scan_id=job["scan_id"],
+            threads=job.get("threads", FETCH_WORKERS),
+            batch_size=job.get("batch_size", BULK_FETCH_SIZE),
+            **kwargs,
+        )
+    elif command == "index":
+        return ResponsysContentIndexer(
+            folder_names=job.get("folders", FOLDER_NAMES),
+            fetch_workers=job.get("fetch_workers", FETCH_WORKERS),
+            parse_workers=job.get("parse_workers", PARSE_WORKERS),
+            **kwargs,
+        )
+    elif command == "expand":
+        return ResponsysTemplateExpander(
+            module_names=build_module_list(
+                job["modules"], job.get("folder", FOLDER_NAMES[0])
+            ),
+            output_path=job.get("output") or EXPANDED_FILE_PATH,
+            **kwargs,
+        )
+    elif command == "snapshot":
+        return ResponsysLibrarySnapshotter(
+            folder_names=job.get("folders"),
+            snapshot_path=job.get("output")
+            or SNAPSHOT_FILE_PATH.format(name=time.strftime("%Y-%m-%d")),
+            base_path=job.get("base"),
+            report_path=job.get("report") or DIFF_FILE_PATH,
+            recursive=job.get("recursive", False),
+            fetch_workers=job.get("fetch_workers", FETCH_WORKERS),
+            parse_workers=job.get("parse_workers", PARSE_WORKERS),
+            **kwargs,
+        )
+    elif command == "update":
+        return ResponsysContentUpdater(
+            replacements=[
+                Replacement(old, new, regex=job.get("regex", False))
+                for old, new in job["replace"]
+            ],
+            module_names=(
+                build_module_list(job["modules"], job.get("folder", FOLDER_NAMES[0]))
+                if job.get("modules")
+                else None
+            ),
+            keywords=job.get("keywords"),
+            folder_names=job.get("folders", FOLDER_NAMES),
+            recursive=job.get("recursive", False),
+            apply=job.get("apply", False),
+            update_workers=job.get("update_workers", UPDATE_WORKERS),
+            rate=job.get("rate", UPDATE_RATE_PER_SECOND),
+            report_path=job.get("report") or UPDATE_DIFF_FILE_PATH,
+            fetch_workers=job.get("fetch_workers", FETCH_WORKERS),
+            parse_workers=job.get("parse_workers", PARSE_WORKERS),
+            **kwargs,
+        )
+    raise ValueError("Unknown job command: {}".format(command))
+
+
+def load_jobs(path: str) -> list:
+    """Reads a job file, either a list of jobs or {"jobs": [...]}"""
+    with open(path) as file:
+        jobs = json.load(file)
+    if isinstance(jobs, dict):
+        jobs = jobs["jobs"]
+    return jobs
+
+
+def run_jobs(jobs: list, workers: int = JOB_WORKERS) -> int:
+    """Runs the jobs on one session, token and worker pool, returns the failures"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(workers, 10))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    token = ResponsysParser(None, session=session).token
+
+    def run_job(job):
+        parser_client = build_job_client(job, session=session, token=token)
+        ResponsysParser(parser_client, session=session, token=token).execute()
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print("Job {job} failed: {error}".format(job=futures[future], error=e))
+    print(
+        "Finished {count} jobs, {failures} failed".format(
+            count=len(jobs), failures=failures
+        )
+    )
+    return failures
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="meteorsys", description="Parse and scan Responsys content."
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=METRICS_FILE_PATH,
+        help="write run metrics as JSON (.json) or Prometheus text",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse = subparsers.add_parser("parse", help="parse the content of modules")
+    parse.add_argument("modules", nargs="+", help="module names without .htm")
+    parse.add_argument("--folder", default=FOLDER_NAMES[0])
+    parse.add_argument("--find-tables", action="store_true")
+    parse.add_argument("--print-content", action="store_true")
+    parse.add_argument("--find-containing-modules", action="store_true")
+    parse.add_argument(
+        "--keep-content",
+        action="store_true",
+        default=KEEP_CONTENT,
+        help="keep parsed content in memory instead of reloading it",
+    )
+
+    expand = subparsers.add_parser(
+        "expand", help="write modules with their includes inlined"
+    )
+    expand.add_argument("modules", nargs="+", help="module names without .htm")
+    expand.add_argument("--folder", default=FOLDER_NAMES[0])
+    expand.add_argument("--output", help="file path with a {module_name} placeholder")
+
+    scan = subparsers.add_parser("scan", help="scan folders for a keyword")
+    scan.add_argument("--keyword", default=SCAN_KEYWORD)
+    scan.add_argument("--folders", nargs="+", default=FOLDER_NAMES)
+    scan.add_argument(
+        "--recursive", action="store_true", help="also scan all subfolders"
+    )
+    scan.add_argument(
+        "--resume", action="store_true", help="skip modules of the last checkpoint"
+    )
+    scan.add_argument("--checkpoint", help="checkpoint file of the scan")
+    scan.add_argument(
+        "--distributed",
+        action="store_true",
+        help="enqueue the modules in Redis for worker processes",
+    )
+    scan.add_argument("--scan-id", help="id of a distributed scan, the keyword")
+    scan.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help="workers of a distributed scan run in this process",
+    )
+
+    worker = subparsers.add_parser(
+        "worker", help="scan the modules of a distributed scan"
+    )
+    worker.add_argument("scan_id")
+    worker.add_argument("--threads", type=int, default=FETCH_WORKERS)
+    worker.add_argument("--batch-size", type=int, default=BULK_FETCH_SIZE)
+
+    index = subparsers.add_parser("index", help="build or update the index")
+    index.add_argument("--folders", nargs="+", default=FOLDER_NAMES)
+
+    snapshot = subparsers.add_parser(
+        "snapshot", help="snapshot the library, reporting changes since --base"
+    )
+    snapshot.add_argument(
+        "--folders", nargs="+", help="defaults to the folders of --base"
+    )
+    snapshot.add_argument("--recursive", action="store_true")
+    snapshot.add_argument("--output", help="snapshot file to write")
+    snapshot.add_argument("--base", help="earlier snapshot file to compare with")
+    snapshot.add_argument("--report", default=DIFF_FILE_PATH)
+
+    diff = subparsers.add_parser("diff", help="report changes between snapshots")
+    diff.add_argument("old", help="earlier snapshot file")
+    diff.add_argument("new", help="later snapshot file")
+    diff.add_argument("--report", default=DIFF_FILE_PATH)
+
+    update = subparsers.add_parser(
+        "update", help="find and replace in modules, a dry run unless --apply"
+    )
+    update.add_argument(
+        "--replace",
+        nargs=2,
+        action="append",
+        required=True,
+        metavar=("OLD", "NEW"),
+        help="may be given many times",
+    )
+    update.add_argument(
+        "--regex", action="store_true", help="OLD are regular expressions"
+    )
+    update.add_argument(
+        "--modules", nargs="+", help="module names without .htm, instead of a scan"
+    )
+    update.add_argument("--folder", default=FOLDER_NAMES[0])
+    update.add_argument(
+        "--keyword",
+        dest="keywords",
+        action="append",
+        help="scan for this keyword, defaults to the literal OLD values",
+    )
+    update.add_argument("--folders", nargs="+", default=FOLDER_NAMES)
+    update.add_argument("--recursive", action="store_true")
+    update.add_argument(
+        "--apply", action="store_true", help="push the updates to Responsys"
+    )
+    update.add_argument("--update-workers", type=int, default=UPDATE_WORKERS)
+    update.add_argument(
+        "--rate",
+        type=float,
+        default=UPDATE_RATE_PER_SECOND,
+        help="maximum requests per second, 0 for no limit",
+    )
+    update.add_argument("--report", default=UPDATE_DIFF_FILE_PATH)
+
+    for subparser in (scan, index, snapshot, update):
+        subparser.add_argument(
+            "--fetch-workers", type=positive_int, default=FETCH_WORKERS
+        )
+        subparser.add_argument(
+            "--parse-workers", type=positive_int, default=PARSE_WORKERS
+        )
+
+    lookup = subparsers.add_parser("lookup", help="look up a name in the index")
+    lookup.add_argument("term")
+    lookup.add_argument("--kind", choices=INDEX_KINDS)
+
+    jobs = subparsers.add_parser("jobs", help="run the jobs of a JSON job file")
+    jobs.add_argument("job_file")
+    jobs.add_argument("--workers", type=int, default=JOB_WORKERS)
+    return parser
+
+
+def run_command(args: argparse.Namespace) -> int:
+    if args.command == "lookup":
+        lookup_index(args.term, args.kind)
+        return 0
+    if args.command == "diff":
+        report_diff(
+            LibrarySnapshot.load(args.old), LibrarySnapshot.load(args.new), args.report
+        )
+        return 0
+    if args.command == "jobs":
+        failures = run_jobs(load_jobs(args.job_file), args.workers)
+        report_metrics(args.metrics_file)
+        return 1 if failures else 0
+
+    job = vars(args)
+    if args.command == "parse":
+        print_run_context(
+            args.modules,
+            "p",
+            args.find_tables,
+            args.find_containing_modules,
+            args.print_content,
+        )
+    failures = run_jobs([job], workers=1)
+    report_metrics(args.metrics_file)
+    return 1 if failures else 0
+
+
 def get_input_modules():
     input_modules = str(input("Enter the input module names (,): "))
     return input_modules.split(", ")
@@ -341,18 +1749,21 @@ def get_proceed():
     return proceed
 
 
-def main():
-    selection = str(input("Enter option: (parse content (p) | scan for keyword (s) "))
+def main(argv: Optional[list] = None):
+    if argv:
+        sys.exit(run_command(build_arg_parser().parse_args(argv)))
+
+    selection = str(
+        input(
+            "Enter option: (parse content (p) | scan for keyword (s) "
+            "| build index (i) | lookup index (l) "
+        )
+    )
     if selection == "p":
         input_modules = get_input_modules()
         folder_name = get_folder_name()
 
-        module_list = [
-            "/contentlibrary/{folder_name}/{input_module}.htm".format(
-                folder_name=folder_name, input_module=input_module
-            )
-            for input_module in input_modules
-        ]
+        module_list = build_module_list(input_modules, folder_name)
 
         find_tables, print_content, find_containing_modules = get_switches()
 
@@ -376,16 +1787,22 @@ def main():
             print_content=print_content,
         )
     elif selection == "s":
-        keyword = "EMAIL_ADDRESS_"
         parser_client = ResponsysFolderScanner(
-            keyword=keyword, folder_names=FOLDER_NAMES
+            keyword=SCAN_KEYWORD, folder_names=FOLDER_NAMES
         )
+    elif selection == "i":
+        parser_client = ResponsysContentIndexer(folder_names=FOLDER_NAMES)
+    elif selection == "l":
+        term = str(input("Enter the variable, function or table name: "))
+        lookup_index(term.strip())
+        return
     else:
         sys.exit(0)
 
     responsys_parser = ResponsysParser(parser_client=parser_client)
     responsys_parser.execute()
+    report_metrics(METRICS_FILE_PATH)
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
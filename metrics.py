@@ -0,0 +1,192 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_PREFIX = "meteorsys"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.mean,
+            "max": self.max,
+            "buckets": dict(zip(map(str, self.buckets), self.bucket_counts)),
+        }
+
+
+class RunMetrics:
+    """Collects timings of HTTP requests, cache tiers and parse stages of a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_request(
+        self, endpoint: str, seconds: float, size: int, status: str
+    ) -> None:
+        self.observe("http_request_seconds", seconds, endpoint=endpoint, status=status)
+        self.increment("http_response_bytes", size, endpoint=endpoint, status=status)
+
+    def record_cache(self, tier: str, hit: bool, seconds: float = 0.0) -> None:
+        result = "hit" if hit else "miss"
+        self.observe("cache_seconds", seconds, tier=tier, result=result)
+
+    @contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+
+        def format_labels(labels):
+            return ",".join('{}="{}"'.format(k, v) for k, v in labels)
+
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = "{}_{}".format(METRIC_PREFIX, name)
+                if metric not in typed:
+                    lines.append("# TYPE {} histogram".format(metric))
+                    typed.add(metric)
+                label_string = format_labels(labels)
+                separator = "," if label_string else ""
+                for bucket, count in zip(histogram.buckets, histogram.bucket_counts):
+                    lines.append(
+                        '{}_bucket{{{}{}le="{}"}} {}'.format(
+                            metric, label_string, separator, bucket, count
+                        )
+                    )
+                lines.append(
+                    '{}_bucket{{{}{}le="+Inf"}} {}'.format(
+                        metric, label_string, separator, histogram.count
+                    )
+                )
+                lines.append(
+                    "{}_sum{{{}}} {}".format(metric, label_string, histogram.sum)
+                )
+                lines.append(
+                    "{}_count{{{}}} {}".format(metric, label_string, histogram.count)
+                )
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = "{}_{}_total".format(METRIC_PREFIX, name)
+                if metric not in typed:
+                    lines.append("# TYPE {} counter".format(metric))
+                    typed.add(metric)
+                lines.append("{}{{{}}} {}".format(metric, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        sizes = {
+            (counter["labels"]["endpoint"], counter["labels"]["status"]): counter[
+                "value"
+            ]
+            for counter in data["counters"]
+            if counter["name"] == "http_response_bytes"
+        }
+        lines = [(40 * "*") + " RUN SUMMARY " + (40 * "*")]
+        sections = (
+            ("http_request_seconds", "HTTP requests", ("endpoint", "status")),
+            ("cache_seconds", "Cache", ("tier", "result")),
+            ("stage_seconds", "Stages", ("stage",)),
+        )
+        for name, title, label_names in sections:
+            histograms = [h for h in data["histograms"] if h["name"] == name]
+            if not histograms:
+                continue
+            lines.append("{}:".format(title))
+            for h in histograms:
+                label = " ".join(str(h["labels"][n]) for n in label_names)
+                line = "\t{:<30} count={:<6} total={:.3f}s".format(
+                    label, h["count"], h["sum"]
+                )
+                line += " mean={:.4f}s max={:.4f}s".format(h["mean"], h["max"])
+                if name == "http_request_seconds":
+                    line += " bytes={}".format(
+                        int(
+                            sizes.get(
+                                (h["labels"]["endpoint"], h["labels"]["status"]), 0
+                            )
+                        )
+                    )
+                lines.append(line)
+        lines.append(93 * "*")
+        return "\n".join(lines)
+
+    def write(self, path: str) -> None:
+        """Writes JSON for .json paths and Prometheus text otherwise"""
+        with open(path, "w") as file:
+            if path.endswith(".json"):
+                json.dump(self.to_dict(), file, indent=2)
+            else:
+                file.write(self.to_prometheus())
+
+
+metrics = RunMetrics()
+
+
+def report_metrics(path: Optional[str] = None) -> None:
+    print(metrics.summary())
+    if path:
+        metrics.write(path)
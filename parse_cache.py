@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import (
+    PARSE_CACHE_KEY,
+    PARSE_CACHE_SIZE,
+    PARSE_CACHE_TTL_SECONDS,
+    PARSER_VERSION,
+)
+from indexer import hash_content
+from metrics import metrics
+from redis_ops import get_from_redis, save_to_redis
+
+
+class ParsedContent:
+    """Includes, queries and table references extracted from one content
+
+    tables holds (folder_name, table_name, qa, qv, offset) tuples.
+    """
+
+    __slots__ = ("includes", "queries", "tables")
+
+    def __init__(self, includes: Optional[list], queries: list, tables: list):
+        self.includes = includes
+        self.queries = queries
+        self.tables = tables
+
+    def dumps(self) -> str:
+        return json.dumps([self.includes, self.queries, self.tables])
+
+    @classmethod
+    def loads(cls, value: str) -> "ParsedContent":
+        includes, queries, tables = json.loads(value)
+        return cls(includes, queries, [tuple(table) for table in tables])
+
+
+class ParseCache:
+    """Parse results keyed by content hash and PARSER_VERSION
+
+    Looked up in a bounded in-process LRU first, then in Redis, so identical
+    modules are parsed once per run and unchanged modules once per version.
+    """
+
+    def __init__(self, size: int = PARSE_CACHE_SIZE, use_redis: bool = True):
+        self.size = size
+        self.use_redis = use_redis
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(content) -> str:
+        return PARSE_CACHE_KEY.format(
+            version=PARSER_VERSION, content_hash=hash_content(content)
+        )
+
+    def get(self, key: str) -> Optional[ParsedContent]:
+        with self.lock:
+            parsed = self.entries.get(key)
+            if parsed is not None:
+                self.entries.move_to_end(key)
+        metrics.record_cache("parse_memory", parsed is not None)
+        if parsed is not None or not self.use_redis:
+            return parsed
+
+        start = time.perf_counter()
+        value = get_from_redis(key)
+        metrics.record_cache("parse_redis", bool(value), time.perf_counter() - start)
+        if not value:
+            return None
+        parsed = ParsedContent.loads(value)
+        self.remember(key, parsed)
+        return parsed
+
+    def set(self, key: str, parsed: ParsedContent) -> None:
+        self.remember(key, parsed)
+        if self.use_redis:
+            save_to_redis(key, parsed.dumps(), ex=PARSE_CACHE_TTL_SECONDS)
+
+    def remember(self, key: str, parsed: ParsedContent) -> None:
+        with self.lock:
+            self.entries[key] = parsed
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+parse_cache = ParseCache()
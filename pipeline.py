@@ -0,0 +1,170 @@
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from config import PIPELINE_QUEUE_SIZE
+from metrics import metrics
+
+# Put into a stage's queue once per worker when the upstream stage is done
+DONE = object()
+
+
+class Stage:
+    """A pipeline stage running func on every item with its own workers
+
+    func returns the item passed downstream, None to drop it or, when many
+    is set, an iterable of items.
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1, many=False):
+        if workers < 1:
+            # Nothing would drain the stage's queue and the pipeline would hang
+            raise ValueError("Stage {} needs at least 1 worker".format(name))
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.many = many
+
+
+class Pipeline:
+    """Runs items through stages connected by bounded queues
+
+    A full queue blocks the stage feeding it, so slow stages apply
+    backpressure upstream and memory stays bounded by the queue sizes.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def put(self, output_queue: queue.Queue, item) -> bool:
+        """Blocks until there is room for item, returns False once cancelled"""
+        while not self.cancelled.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_worker(self, stage: Stage, input_queue, output_queue, finished) -> None:
+        while True:
+            item = input_queue.get()
+            if item is DONE:
+                break
+            if self.cancelled.is_set():
+                # Drain, so upstream stages blocked on this queue can finish
+                continue
+            try:
+                with metrics.stage("pipeline_{}".format(stage.name)):
+                    result = stage.func(item)
+            except Exception as e:
+                print("{} failed for {}: {!r}".format(stage.name, item, e))
+                continue
+            if result is None or output_queue is None:
+                continue
+            for output in result if stage.many else (result,):
+                if not self.put(output_queue, output):
+                    break
+        finished()
+
+    def run(self, source: Iterable, results: Optional[queue.Queue] = None) -> None:
+        """Feeds the source items to the first stage and waits for all stages
+
+        The outputs of the last stage are put into results, if given.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(results)
+        threads = []
+        for i, stage in enumerate(self.stages):
+            output_queue = queues[i + 1]
+            finished = self.finisher(stage, output_queue)
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.run_worker,
+                    args=(stage, queues[i], output_queue, finished),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in source:
+                if not self.put(queues[0], item):
+                    break
+        except BaseException:
+            # e.g. Ctrl-C, queued items are dropped instead of processed
+            self.cancel()
+            raise
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(DONE)
+            try:
+                for thread in threads:
+                    thread.join()
+            except BaseException:
+                # e.g. Ctrl-C while the workers process the queued items
+                self.cancel()
+                raise
+
+    def iter(self, source: Iterable) -> Iterator:
+        """Runs the pipeline in the background, yielding the last stage's outputs
+
+        At most queue_size outputs are buffered ahead of the consumer. Closing
+        the generator, e.g. by breaking out of a for loop, cancels the run.
+        """
+        results = queue.Queue(maxsize=self.queue_size)
+        closed = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                self.run(source, results)
+            except BaseException as e:
+                errors.append(e)
+            # Also signalled when the run was cancelled, unless nobody listens
+            while not closed.is_set():
+                try:
+                    results.put(DONE, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is DONE:
+                    break
+                yield item
+        finally:
+            closed.set()
+            if thread.is_alive():
+                self.cancel()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def finisher(self, stage: Stage, output_queue) -> Callable:
+        """Returns a callback signalling the next stage after the last worker"""
+        lock = threading.Lock()
+        remaining = [stage.workers]
+        index = self.stages.index(stage)
+        next_workers = (
+            self.stages[index + 1].workers if index + 1 < len(self.stages) else 0
+        )
+
+        def finished():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            for _ in range(next_workers):
+                output_queue.put(DONE)
+
+        return finished
@@ -0,0 +1,123 @@
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Union
+
+TABLE_KEY_PREFIX = "TABLE-"
+MEMBER_KEY_PREFIX = "MEMBER-"
+FIELD_KEYS = ("module_name", "queries", "content", "called_modules")
+
+
+class ModuleResult:
+    """Parse result of one module
+
+    tables maps table names to their fields, lookups holds the
+    (table_name, qa, qv) lookups of its queries and members maps lookup values
+    to their table member. Content can be dropped after parsing, it is then
+    reloaded with content_loader whenever it is read.
+
+    Also readable as the dict parse_content used to return, with TABLE-<name>
+    and MEMBER-<qv> keys.
+    """
+
+    __slots__ = (
+        "module_name",
+        "queries",
+        "called_modules",
+        "tables",
+        "lookups",
+        "members",
+        "content_loader",
+        "_content",
+    )
+
+    def __init__(
+        self,
+        module_name: str,
+        queries: List[str],
+        content: Optional[Union[str, bytes]] = None,
+        called_modules: Optional[List[str]] = None,
+        tables: Optional[Dict[str, list]] = None,
+        lookups: Optional[List[tuple]] = None,
+        members: Optional[Dict[str, dict]] = None,
+        content_loader: Optional[Callable] = None,
+    ):
+        self.module_name = module_name
+        self.queries = queries
+        self.called_modules = called_modules
+        self.tables = tables or {}
+        self.lookups = lookups or []
+        self.members = members or {}
+        self.content_loader = content_loader
+        self._content = content
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ModuleResult":
+        tables, members = {}, {}
+        for key, value in data.items():
+            if key.startswith(TABLE_KEY_PREFIX):
+                tables[key[len(TABLE_KEY_PREFIX) :]] = value
+            elif key.startswith(MEMBER_KEY_PREFIX):
+                members[key[len(MEMBER_KEY_PREFIX) :]] = value
+        return cls(
+            data["module_name"],
+            data["queries"],
+            content=data.get("content"),
+            called_modules=data.get("called_modules"),
+            tables=tables,
+            members=members,
+        )
+
+    @property
+    def content(self) -> Optional[Union[str, bytes]]:
+        if self._content is None and self.content_loader:
+            # Not kept, a reload is cheap next to holding every module's content
+            return self.content_loader(self.module_name)
+        return self._content
+
+    def drop_content(self, content_loader: Optional[Callable] = None) -> None:
+        self._content = None
+        self.content_loader = content_loader or self.content_loader
+
+    def keys(self) -> Iterator[str]:
+        yield from FIELD_KEYS
+        for table_name in self.tables:
+            yield TABLE_KEY_PREFIX + table_name
+        for qv in self.members:
+            yield MEMBER_KEY_PREFIX + qv
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+    def items(self) -> Iterator[tuple]:
+        for key in self.keys():
+            yield key, self[key]
+
+    def __getitem__(self, key: str):
+        if key in FIELD_KEYS:
+            return getattr(self, key)
+        if key.startswith(TABLE_KEY_PREFIX):
+            return self.tables[key[len(TABLE_KEY_PREFIX) :]]
+        if key.startswith(MEMBER_KEY_PREFIX):
+            return self.members[key[len(MEMBER_KEY_PREFIX) :]]
+        raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return "ModuleResult({!r}, queries={}, tables={}, members={})".format(
+            self.module_name, len(self.queries), len(self.tables), len(self.members)
+        )
+
+
+class ScanMatch(NamedTuple):
+    """Module of a folder scan matching at least one of the keywords"""
+
+    folder_name: str
+    module_name: str
+    keywords: List[str]
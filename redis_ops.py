@@ -1,16 +1,61 @@
-from typing import Optional
+from typing import Dict, List, Optional
 
 import redis
 
-redis_client = redis.Redis()
+# Constructed on first use, see get_redis_client
+redis_client = None
+
+
+def get_redis_client() -> redis.Redis:
+    global redis_client
+    if redis_client is None:
+        redis_client = redis.Redis()
+    return redis_client
 
 
 def save_to_redis(key: str, value: str, ex: int = None):
-    redis_client.set(key, value, ex=ex)
+    get_redis_client().set(key, value, ex=ex)
+
+
+def get_raw_from_redis(key: str) -> Optional[bytes]:
+    client = get_redis_client()
+    value = client.get(key)
+    if not value and key != key.lower():
+        value = client.get(key.lower())
+    return value
 
 
 def get_from_redis(key: str) -> Optional[str]:
-    value = redis_client.get(key)
-    if not value:
-        value = redis_client.get(key.lower())
+    value = get_raw_from_redis(key)
     return value.decode("utf-8") if value else value
+
+
+def get_many_from_redis(keys: List[str], decode: bool = True) -> list:
+    """Returns the values of many keys in one round trip, as bytes unless decode"""
+    if not keys:
+        return []
+    client = get_redis_client()
+    values = client.mget(keys)
+    misses = [
+        i for i, value in enumerate(values) if not value and keys[i] != keys[i].lower()
+    ]
+    if misses:
+        lower_values = client.mget([keys[i].lower() for i in misses])
+        for i, value in zip(misses, lower_values):
+            values[i] = value
+    if not decode:
+        return values
+    return [value.decode("utf-8") if value else value for value in values]
+
+
+def save_many_to_redis(mapping: Dict[str, str], ex: int = None):
+    if not mapping:
+        return
+    pipeline = get_redis_client().pipeline()
+    for key, value in mapping.items():
+        pipeline.set(key, value, ex=ex)
+    pipeline.execute()
+
+
+def delete_from_redis(key: str):
+    get_redis_client().delete(key)
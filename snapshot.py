@@ -0,0 +1,135 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Set
+
+
+class LibrarySnapshot:
+    """Content hash, includes, queries and tables of every module at one time"""
+
+    def __init__(self, folder_names: Optional[list] = None, taken_at: str = ""):
+        self.folder_names = list(folder_names or [])
+        self.taken_at = taken_at or time.strftime("%Y-%m-%d %H:%M:%S")
+        # module name -> {"hash", "includes", "queries", "tables"}
+        self.modules: Dict[str, dict] = {}
+
+    def add_module(
+        self,
+        module_name: str,
+        content_hash: str,
+        includes: List[str],
+        queries: List[str],
+        tables: List[str],
+    ) -> None:
+        self.modules[module_name] = {
+            "hash": content_hash,
+            "includes": sorted(set(includes)),
+            "queries": queries,
+            "tables": sorted(set(tables)),
+        }
+
+    def is_current(self, module_name: str, content_hash: str) -> bool:
+        module = self.modules.get(module_name)
+        return module is not None and module["hash"] == content_hash
+
+    def dependents(self) -> Dict[str, Set[str]]:
+        """Returns {module name: modules including it}"""
+        dependents = {}
+        for module_name, module in self.modules.items():
+            for include in module["includes"]:
+                dependents.setdefault(include, set()).add(module_name)
+        return dependents
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as file:
+            json.dump(
+                {
+                    "folder_names": self.folder_names,
+                    "taken_at": self.taken_at,
+                    "modules": self.modules,
+                },
+                file,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LibrarySnapshot":
+        with open(path) as file:
+            data = json.load(file)
+        snapshot = cls(data["folder_names"], data["taken_at"])
+        snapshot.modules = data["modules"]
+        return snapshot
+
+
+def diff_snapshots(old: LibrarySnapshot, new: LibrarySnapshot) -> dict:
+    """Compares two snapshots by content hash
+
+    Changed modules list what was added to and removed from their includes,
+    queries and tables. affected maps every module reaching an added, removed
+    or changed module through includes to the includes it reaches them by.
+    """
+    added = sorted(set(new.modules) - set(old.modules))
+    removed = sorted(set(old.modules) - set(new.modules))
+    changed = {}
+    for module_name in sorted(set(old.modules) & set(new.modules)):
+        before, after = old.modules[module_name], new.modules[module_name]
+        if before["hash"] == after["hash"]:
+            continue
+        changed[module_name] = {
+            "{}_{}".format(key, change): sorted(difference)
+            for key in ("includes", "queries", "tables")
+            for change, difference in (
+                ("added", set(after[key]) - set(before[key])),
+                ("removed", set(before[key]) - set(after[key])),
+            )
+        }
+
+    # Dependents of removed modules are only known from the old snapshot
+    dependents = old.dependents()
+    for include, module_names in new.dependents().items():
+        dependents.setdefault(include, set()).update(module_names)
+    modified = set(added) | set(removed) | set(changed)
+    affected: Dict[str, Set[str]] = {}
+    pending = list(modified)
+    while pending:
+        include = pending.pop()
+        for module_name in dependents.get(include, ()):
+            if module_name in modified or module_name not in new.modules:
+                continue
+            if module_name not in affected:
+                affected[module_name] = set()
+                pending.append(module_name)
+            affected[module_name].add(include)
+
+    return {
+        "old": old.taken_at,
+        "new": new.taken_at,
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+        "affected": {name: sorted(affected[name]) for name in sorted(affected)},
+    }
+
+
+def format_diff(diff: dict) -> str:
+    content = (40 * "*") + " CHANGES " + (40 * "*") + "\n"
+    content += "From {old} to {new}\n\n".format(old=diff["old"], new=diff["new"])
+    for title, module_names in (
+        ("Added", diff["added"]),
+        ("Removed", diff["removed"]),
+        ("Changed", list(diff["changed"])),
+    ):
+        content += "{} ({}):\n".format(title, len(module_names))
+        for module_name in module_names:
+            content += "\t{}\n".format(module_name)
+            for key, values in diff["changed"].get(module_name, {}).items():
+                for value in values:
+                    content += "\t\t{}: {}\n".format(key.replace("_", " "), value)
+        content += "\n"
+
+    content += "Affected through includes ({}):\n".format(len(diff["affected"]))
+    for module_name, includes in diff["affected"].items():
+        content += "\t{} (includes {})\n".format(module_name, ", ".join(includes))
+    return content
@@ -0,0 +1,352 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import fakeredis
+import requests
+
+import redis_ops
+from config import settings
+from meteorsys import ResponsysFolderScanner, ResponsysParser
+from metrics import metrics, report_metrics
+from synthetic import generate_library
+
+API_PREFIX = "/rest/api/v1.3"
+STANDIN_FOLDER = "standin"
+
+
+class StandInConfig:
+    """Fault injection of the stand-in server"""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        token_ttl: Optional[float] = None,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without this every keep-alive
+    # response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, data: dict, headers: Optional[dict] = None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_faults(self, authenticate: bool = True) -> bool:
+        """Sleeps and answers with an injected failure, returns True if it did"""
+        server = self.server
+        config = server.config
+        with server.lock:
+            server.request_count += 1
+            delay = config.latency + config.random.uniform(0, config.jitter)
+            throttled = config.random.random() < config.throttle_rate
+            failed = config.random.random() < config.error_rate
+        if delay:
+            time.sleep(delay)
+
+        if throttled:
+            self.send_json(
+                429, {"errorCode": "TOO_MANY_REQUESTS"}, {"Retry-After": "0"}
+            )
+            return True
+        if failed:
+            self.send_json(500, {"errorCode": "INTERNAL_ERROR"})
+            return True
+        if authenticate and not server.is_valid_token(
+            self.headers.get("Authorization")
+        ):
+            self.send_json(
+                401, {"errorCode": "TOKEN_EXPIRED", "detail": "Token expired"}
+            )
+            return True
+        return False
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path != API_PREFIX + "/auth/token":
+            return self.send_json(404, {"errorCode": "NOT_FOUND"})
+        if self.inject_faults(authenticate=False):
+            return
+        form = parse_qs(body.decode("utf-8"))
+        if not form.get("user_name") or not form.get("password"):
+            return self.send_json(401, {"errorCode": "INVALID_CREDENTIALS"})
+        self.send_json(200, {"authToken": self.server.issue_token()})
+
+    def do_PUT(self):
+        body = self.read_body()
+        if self.inject_faults():
+            return
+        path = urlsplit(self.path).path
+        prefix = API_PREFIX + "/clContent"
+        if not path.startswith(prefix):
+            return self.send_json(404, {"errorCode": "NOT_FOUND"})
+        document_path = "/" + unquote(path[len(prefix) :]).lstrip("/")
+        if document_path not in self.server.library:
+            return self.send_json(404, {"errorCode": "DOCUMENT_NOT_FOUND"})
+        content = json.loads(body)["content"]
+        self.server.library[document_path] = content
+        self.send_json(200, {"documentPath": document_path, "content": content})
+
+    def do_GET(self):
+        if self.inject_faults():
+            return
+        url = urlsplit(self.path)
+        path, query = unquote(url.path), parse_qs(url.query)
+        library = self.server.library
+
+        if path.startswith(API_PREFIX + "/clContent/"):
+            document_path = "/" + path[len(API_PREFIX + "/clContent/") :].lstrip("/")
+            if document_path not in library:
+                return self.send_json(404, {"errorCode": "DOCUMENT_NOT_FOUND"})
+            return self.send_json(
+                200, {"documentPath": document_path, "content": library[document_path]}
+            )
+
+        if path.startswith(API_PREFIX + "/clFolders/"):
+            folder_path = "/" + path[len(API_PREFIX + "/clFolders/") :].strip("/")
+            return self.send_json(200, self.server.list_folder(folder_path, query))
+
+        if path.startswith(API_PREFIX + "/folders/") and "/suppData/" in path:
+            parts = path[len(API_PREFIX + "/folders/") :].split("/")
+            table_name = parts[2]
+            if len(parts) > 3 and parts[3] == "members":
+                ids = query.get("id", [])
+                qa = query.get("qa", ["ID"])[0]
+                return self.send_json(
+                    200,
+                    {
+                        "recordData": {
+                            "fieldNames": [qa, "TITLE"],
+                            "records": [
+                                [id, "{} {}".format(table_name, id)] for id in ids
+                            ],
+                            "mapTemplateName": None,
+                        }
+                    },
+                )
+            return self.send_json(
+                200,
+                {
+                    "fields": [
+                        {"fieldName": "ID", "fieldType": "STR500"},
+                        {"fieldName": "TITLE", "fieldType": "STR500"},
+                    ]
+                },
+            )
+
+        self.send_json(404, {"errorCode": "NOT_FOUND"})
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for the Responsys endpoints used by the parser
+
+    Serves login, content, table, table members, folder listing and content
+    update endpoints from an in-memory content library.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        library: Dict[str, str],
+        config: Optional[StandInConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), StandInHandler)
+        self.library = library
+        self.config = config or StandInConfig()
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, float] = {}
+        self.request_count = 0
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return "http://{}:{}{}".format(host, port, API_PREFIX)
+
+    def urls(self) -> dict:
+        """Returns the settings pointing the parser at this server"""
+        base_url = self.base_url
+        return {
+            "LOGIN_URL": base_url + "/auth/token",
+            "CONTENT_URL": base_url + "/clContent",
+            "TABLE_URL": base_url + "/folders/{folder_name}/suppData/{table_name}",
+            "TABLE_MEMBERS_URL": base_url
+            + "/folders/!MasterData/suppData/{table_name}/members?{query}",
+            "LIST_CONTENTS_URL": base_url
+            + "/clFolders/contentlibrary/{folder_name}?type={type}",
+            "UPDATE_CONTENT_URL": base_url + "/clContent",
+        }
+
+    def issue_token(self) -> str:
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.monotonic()
+        return token
+
+    def is_valid_token(self, token: Optional[str]) -> bool:
+        with self.lock:
+            issued = self.tokens.get(token)
+        if issued is None:
+            return False
+        ttl = self.config.token_ttl
+        return ttl is None or time.monotonic() - issued < ttl
+
+    def list_folder(self, folder_path: str, query: dict) -> dict:
+        prefix = folder_path + "/"
+        documents, folders = [], set()
+        for document_path in self.library:
+            if not document_path.startswith(prefix):
+                continue
+            rest = document_path[len(prefix) :]
+            if "/" in rest:
+                folders.add(prefix + rest.split("/", 1)[0])
+            else:
+                documents.append({"documentPath": document_path, "content": None})
+
+        listing_type = query.get("type", ["all"])[0]
+        data = {}
+        if listing_type in ("all", "docs"):
+            data["documents"] = documents
+        if listing_type in ("all", "folders"):
+            data["folders"] = [{"folderPath": folder} for folder in sorted(folders)]
+        return data
+
+    def start(self) -> "StandInServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def run_load_test(
+    server: StandInServer, keyword: str, folder_names: list, use_redis: bool = False
+) -> dict:
+    """Scans the stand-in library with a fresh session and returns throughput"""
+    if not use_redis:
+        # Keeps the stand-in content out of the real content cache
+        redis_ops.redis_client = fakeredis.FakeRedis()
+    settings.configure(USERNAME="standin", PASSWORD="standin", **server.urls())
+    metrics.reset()
+
+    session = requests.Session()
+    token = ResponsysParser(None, session=session).token
+    scanner = ResponsysFolderScanner(
+        keyword=keyword, folder_names=folder_names, session=session, token=token
+    )
+    requests_before = server.request_count
+    start = time.perf_counter()
+    scanner.execute()
+    elapsed = time.perf_counter() - start
+
+    request_count = server.request_count - requests_before
+    return {
+        "modules": len(server.library),
+        "requests": request_count,
+        "seconds": elapsed,
+        "requests_per_second": request_count / elapsed if elapsed else 0.0,
+    }
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Local Responsys stand-in server.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--modules", type=int, default=500)
+    parser.add_argument("--size", type=int, default=8000)
+    parser.add_argument("--includes", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--token-ttl", type=float, help="seconds until 401")
+    parser.add_argument(
+        "--load-test", metavar="KEYWORD", help="scan the library and exit"
+    )
+    parser.add_argument(
+        "--redis", action="store_true", help="use the real Redis in the load test"
+    )
+    args = parser.parse_args(argv)
+
+    library = generate_library(
+        seed=args.seed,
+        modules=args.modules,
+        folder=STANDIN_FOLDER,
+        size=args.size,
+        includes=args.includes,
+    )
+    config = StandInConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        token_ttl=args.token_ttl,
+        seed=args.seed,
+    )
+    port = 0 if args.load_test else args.port
+    with StandInServer(library, config, port=port) as server:
+        if args.load_test:
+            result = run_load_test(
+                server, args.load_test, [STANDIN_FOLDER], use_redis=args.redis
+            )
+            report_metrics()
+            print(
+                "Scanned {modules} modules with {requests} requests in "
+                "{seconds:.2f}s ({requests_per_second:.1f} requests/s)".format(**result)
+            )
+            return
+
+        print("Serving {} modules, point the parser at it with:".format(len(library)))
+        for name, url in server.urls().items():
+            print("{}={}".format(name, url))
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,138 @@
+import random
+from typing import Dict, List, Optional
+
+VARIABLE_NAMES = [
+    "FIRST_NAME",
+    "LAST_NAME",
+    "EMAIL_ADDRESS_",
+    "RIID_",
+    "CITY",
+    "COUNTRY",
+    "LANG",
+    "COURSE_ID",
+    "WISHLIST_COURSES",
+    "CAMPAIGN_NAME",
+]
+TABLE_NAMES = ["ALL_USERS", "COURSES", "TRANSLATIONS", "PROMOTIONS"]
+# Mixed scripts, so templates look like our multilingual content
+WORDS = [
+    "course",
+    "learn",
+    "today",
+    "offer",
+    "Kurs",
+    "für",
+    "cours",
+    "découvrez",
+    "curso",
+    "aprenda",
+    "コース",
+    "学ぶ",
+    "курс",
+    "учиться",
+]
+HTML_LINES = [
+    '<tr><td style="padding:0 20px;font-family:Arial,sans-serif;">{text}</td></tr>',
+    '<p style="margin:0;line-height:1.5;">{text}</p>',
+    '<a href="https://example.com/{slug}?utm_source=email" target="_blank">{text}</a>',
+    '<img src="https://example.com/{slug}.png" alt="{text}" width="600" />',
+]
+
+
+def module_path(folder: str, index: int) -> str:
+    return "/contentlibrary/{folder}/module_{index:04d}.htm".format(
+        folder=folder, index=index
+    )
+
+
+def build_include(rng: random.Random, path: str) -> str:
+    """Returns a document(...) call for a /contentlibrary/folder/name.htm path"""
+    folder, name = path.strip("/").rsplit("/", 1)
+    word = rng.choice(("document", "documentnobr"))
+    return "{word}({folder}, {name})".format(word=word, folder=folder, name=name)
+
+
+def build_lookup(rng: random.Random, nesting_depth: int) -> str:
+    """Returns a Responsys tag nested nesting_depth conditions deep"""
+    variable = rng.choice(VARIABLE_NAMES)
+    kind = rng.random()
+    if kind < 0.6:
+        expression = "LOOKUP({})".format(variable)
+    elif kind < 0.8:
+        expression = (
+            "SETVARS(VARLIST(1, USERS, LOOKUPRECORDS(!MasterData, {table}, "
+            "PAIRS(RIID_, LOOKUP(RIID_), ID, LOOKUP({variable})), TITLE)))"
+        ).format(table=rng.choice(TABLE_NAMES), variable=variable)
+    else:
+        expression = (
+            "LOOKUPTABLE(!MasterData, {table}, ID, LOOKUP({variable}), TITLE)"
+        ).format(table=rng.choice(TABLE_NAMES), variable=variable)
+    for _ in range(nesting_depth):
+        expression = "COND(EMPTY(LOOKUP({variable})), NOTHING(), {expression})".format(
+            variable=rng.choice(VARIABLE_NAMES), expression=expression
+        )
+    return "${}$".format(expression)
+
+
+def generate_template(
+    rng: random.Random,
+    size: int = 4000,
+    include_paths: Optional[List[str]] = None,
+    lookup_density: float = 0.3,
+    nesting_depth: int = 1,
+) -> str:
+    """Generates a Responsys template of roughly size characters
+
+    lookup_density is the share of lines carrying a Responsys tag and every
+    include path is called once with document(...) or documentnobr(...).
+    """
+    lines = ["<html><body>", '<table width="100%" cellpadding="0">']
+    length = sum(map(len, lines))
+    while length < size:
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        if rng.random() < lookup_density:
+            depth = rng.randint(0, nesting_depth)
+            text = "{} {}".format(text, build_lookup(rng, depth))
+        line = rng.choice(HTML_LINES).format(
+            text=text, slug=rng.choice(VARIABLE_NAMES).lower()
+        )
+        lines.append(line)
+        length += len(line) + 1
+
+    for path in include_paths or []:
+        position = rng.randint(2, len(lines))
+        lines.insert(position, "${}$".format(build_include(rng, path)))
+    lines.extend(["</table>", "</body></html>"])
+    return "\n".join(lines)
+
+
+def generate_library(
+    seed: int = 0,
+    modules: int = 100,
+    folder: str = "modules",
+    size: int = 4000,
+    includes: int = 2,
+    lookup_density: float = 0.3,
+    nesting_depth: int = 1,
+) -> Dict[str, str]:
+    """Generates {document path: content} for a seeded content library
+
+    Modules only include modules with a higher number, so the include graph
+    has no cycles.
+    """
+    rng = random.Random(seed)
+    library = {}
+    for index in range(modules):
+        candidates = range(index + 1, modules)
+        include_paths = [
+            module_path(folder, i)
+            for i in rng.sample(candidates, min(includes, len(candidates)))
+        ]
+        library[module_path(folder, index)] = generate_template(
+            rng,
+            size=size,
+            include_paths=include_paths,
+            lookup_density=lookup_density,
+            nesting_depth=nesting_depth,
+        )
+    return library
@@ -1,39 +1,76 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 from unittest import TestCase
 from unittest import main as unittest_main
 from unittest import mock
 
 import fakeredis
+import requests
 from decouple import config
 
+from benchmarks import run_benchmarks
+from checkpoint import ScanCheckpoint
 from config import (
     CONTENT_URL,
+    FOLDER_TREE_KEY,
     LIST_CONTENTS_URL,
     LOGIN_URL,
     QUERY_FILE_PATH,
     RESPONSYS_AUTH_TOKEN_KEY,
+    SCAN_MAX_ATTEMPTS,
     TABLE_MEMBERS_URL,
     TABLE_URL,
+    LazySettings,
+    settings,
 )
+from daemon import DaemonHTTPServer, DaemonUnixServer, MeteorsysDaemon, SingleFlight
+from distributed import FAILED as SCAN_FAILED
+from distributed import MATCH, ScanQueue
 from exceptions import TokenExpiredException
+from expander import TemplateExpander
 from fixtures import (
+    CONTAINED_MODULE_RESPONSE,
+    CONTAINING_MODULE_RESPONSE,
     CONTENT_RESPONSE,
     CONTENT_RESPONSES,
     LIST_CONTENTS_RESPONSE,
+    TABLE_MEMBERS_BATCH_RESPONSE,
     TABLE_MEMBERS_RESPONSE,
     TABLE_RESPONSE,
     TOKEN_EXPIRED_RESPONSE,
 )
 from helpers import dump_list, print_run_context, write_queries_to_file
+from indexer import ContentIndex, hash_content
 from meteorsys import (
+    ResponsysContentIndexer,
+    ResponsysContentUpdater,
     ResponsysFolderScanner,
+    ResponsysLibrarySnapshotter,
     ResponsysModuleParser,
     ResponsysParser,
+    ResponsysScanCoordinator,
+    build_arg_parser,
     get_folder_name,
     get_input_modules,
     get_proceed,
     get_switches,
+    load_jobs,
     main,
+    run_jobs,
 )
+from metrics import RunMetrics, metrics
+from parse_cache import ParseCache, ParsedContent, parse_cache
+from pipeline import Pipeline, Stage
+from records import ModuleResult, ScanMatch
+from redis_ops import get_from_redis, save_to_redis
+from snapshot import LibrarySnapshot, diff_snapshots, format_diff
+from standin import StandInConfig, StandInServer
+from synthetic import generate_library
+from updater import CONFLICT, UPDATED, RateLimiter, Replacement, plan_update
 
 fake_redis = fakeredis.FakeRedis()
 
@@ -47,6 +84,10 @@ class MockResponse:
     def ok(self):
         return self.status_code == 200
 
+    @property
+    def content(self):
+        return json.dumps(self.json_data).encode("utf-8")
+
     def json(self):
         return self.json_data
 
@@ -78,7 +119,7 @@ def mock_get_contents_of_folder(self, folder_name):
     return
 
 
-def mock_parse_content(self, module_name, depth=1):
+def mock_parse_content(self, module_name, depth=1, content=None):
     return
 
 
@@ -119,6 +160,25 @@ class TestResponsysParser(TestCase):
         with self.assertRaises(TokenExpiredException):
             parser.get_content("generic.htm")
 
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_get_contents_only_requests_cache_misses(self, m_get, m_post):
+        """
+        Test that it checks the cache once and only fetches the missing modules
+        """
+        fake_redis.set("bulk/cached.htm", "<html>cached</html>")
+        parser = ResponsysParser(None)
+        contents = parser.get_contents(
+            ["bulk/cached.htm", "bulk/generic.htm", "bulk/containing.htm"]
+        )
+
+        self.assertEqual(contents["bulk/cached.htm"], "<html>cached</html>")
+        self.assertEqual(contents["bulk/generic.htm"], CONTENT_RESPONSE["content"])
+        self.assertEqual(m_get.call_count, 2)
+        self.assertEqual(
+            get_from_redis("bulk/generic.htm"), CONTENT_RESPONSE["content"]
+        )
+        fake_redis.delete("bulk/cached.htm", "bulk/generic.htm", "bulk/containing.htm")
+
     @mock.patch("requests.get", side_effect=mocked_get_request)
     def test_get_table_correctly_returns_fields_content(self, m_get, m_post):
         """
@@ -130,25 +190,86 @@ class TestResponsysParser(TestCase):
         self.assertEqual(fields, TABLE_RESPONSE["fields"])
 
     @mock.patch("requests.get", side_effect=mocked_get_request)
-    @mock.patch("meteorsys.TABLES_TO_QUERIES_DICT", return_value=mock.MagicMock())
-    def test_get_table_members_correctly_returns_members_content(
-        self, m_dict, m_get, m_post
-    ):
+    @mock.patch(
+        "meteorsys.TABLES_TO_QUERIES_DICT",
+        {"ALL_USERS": {"fs": "TITLE", "qav": {"ID": "1"}}},
+    )
+    def test_get_table_members_correctly_returns_members_content(self, m_get, m_post):
         """
         Test that it can correctly return table members content
         """
+        parser = ResponsysParser(None)
+        lookups = [
+            ("ALL_USERS", "ID", "ID"),
+            ("ALL_USERS", "ID", "OTHER_ID"),
+            ("ALL_USERS", "EMAIL", "EMAIL"),
+            ("USERS", "ID", "ID"),
+        ]
+        table_members = parser.get_table_members(lookups)
 
-        d = {"ALL_USERS": {"fs": "TITLE", "qav": {"ID": "1"}}}
-        m_dict.__getitem__.side_effect = d.__getitem__
+        # Then only the configured lookup column is requested, once
+        self.assertEqual(m_get.call_count, 1)
+        url = m_get.call_args_list[0][0][0]
+        self.assertTrue("ALL_USERS" in url)
+        self.assertTrue("qa=ID&id=1&fs=TITLE,ID" in url)
+        self.assertEqual(
+            table_members,
+            {
+                ("ALL_USERS", "ID", "ID"): {"TITLE": "John Doe"},
+                ("ALL_USERS", "ID", "OTHER_ID"): {"TITLE": "John Doe"},
+            },
+        )
+
+    @mock.patch("requests.get")
+    @mock.patch(
+        "meteorsys.TABLES_TO_QUERIES_DICT",
+        {"ALL_USERS": {"fs": "TITLE", "qav": {"ID": "1", "MANAGER_ID": "2"}}},
+    )
+    def test_get_table_members_requests_each_column_once(self, m_get, m_post):
+        """
+        Test that lookups of the same table column are deduplicated
+        """
+        m_get.return_value = MockResponse(TABLE_MEMBERS_BATCH_RESPONSE, 200)
         parser = ResponsysParser(None)
-        table_members = parser.get_table_member("ALL_USERS")
+        members = parser.get_table_members(
+            [
+                ("ALL_USERS", "ID", "ID"),
+                ("ALL_USERS", "ID", "ID"),
+                ("ALL_USERS", "ID", "OTHER_ID"),
+                ("ALL_USERS", "MANAGER_ID", "MANAGER"),
+            ]
+        )
 
         # Then
-        self.assertTrue("qa=ID" in m_get.call_args_list[0][0][0])
-        self.assertTrue("id=1" in m_get.call_args_list[0][0][0])
-        self.assertTrue("fs=TITLE" in m_get.call_args_list[0][0][0])
-        self.assertTrue("ALL_USERS" in m_get.call_args_list[0][0][0])
-        self.assertEqual(table_members, "John Doe")
+        self.assertEqual(m_get.call_count, 2)
+        urls = sorted(call[0][0] for call in m_get.call_args_list)
+        self.assertTrue("qa=ID&id=1&fs=TITLE,ID" in urls[0])
+        self.assertTrue("qa=MANAGER_ID&id=2&fs=TITLE,MANAGER_ID" in urls[1])
+        self.assertEqual(members[("ALL_USERS", "ID", "ID")]["TITLE"], "John Doe")
+        self.assertEqual(members[("ALL_USERS", "ID", "OTHER_ID")]["TITLE"], "John Doe")
+        # Without the query column the first record is the member
+        self.assertEqual(
+            members[("ALL_USERS", "MANAGER_ID", "MANAGER")]["TITLE"], "Jane Doe"
+        )
+
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    @mock.patch(
+        "meteorsys.TABLES_TO_QUERIES_DICT",
+        {"ALL_USERS": {"fs": "TITLE", "qav": {"RIID_": "1"}}},
+    )
+    def test_attach_table_members_sets_member_records(self, m_get, m_post):
+        """
+        Test that the fetched members are attached to the parsed modules
+        """
+        parser = ResponsysModuleParser(
+            module_names=["contained.htm"],
+            find_containing_modules=False,
+            find_tables=True,
+            print_content=False,
+        )
+        list_of_queries = parser.parse_content("contained.htm", 1)
+        parser.attach_table_members(list_of_queries)
+        self.assertEqual(list_of_queries[0]["MEMBER-RIID_"], {"TITLE": "John Doe"})
 
     def tearDown(self):
         fake_redis.delete(RESPONSYS_AUTH_TOKEN_KEY)
@@ -243,10 +364,355 @@ class TestResponsysModuleParser(TestCase):
 
         self.assertEqual(list_of_queries, [])
 
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_parse_content_keeps_content_only_when_asked(self, m_get, m_post):
+        for keep_content in (True, False):
+            parser_client = ResponsysModuleParser(
+                module_names=["generic.htm"],
+                find_containing_modules=False,
+                find_tables=False,
+                print_content=False,
+                keep_content=keep_content,
+            )
+            with mock.patch.object(
+                parser_client, "fetch_content", return_value="<p>reloaded</p>"
+            ):
+                result = parser_client.parse_content(
+                    "generic.htm", 1, content=CONTENT_RESPONSE["content"]
+                )[0]
+                expected = (
+                    CONTENT_RESPONSE["content"] if keep_content else "<p>reloaded</p>"
+                )
+                self.assertEqual(result.content, expected)
+
+    def test_parse_bytes_matches_parse_str(self, m_post):
+        parser_client = ResponsysModuleParser(
+            module_names=[],
+            find_containing_modules=True,
+            find_tables=False,
+            print_content=False,
+        )
+        content = (
+            "<p>コース für\t$document(contentlibrary/modules, généric.htm)$</p>\n"
+            "$LOOKUPTABLE(!MasterData, ALL_USERS, RIID_, LOOKUP(RIID_), TITLE)$\n"
+            "$documentnobr(contentlibrary/modules, containing.htm)$"
+        )
+        raw_content = content.encode("utf-8")
+
+        module_names = parser_client.parse_module(raw_content)
+        self.assertEqual(module_names, parser_client.parse_module(content))
+        self.assertEqual(
+            module_names,
+            [
+                "contentlibrary/modules, g\\xe9n\\xe9ric.htm",
+                "contentlibrary/modules, containing.htm",
+            ],
+        )
+        queries = parser_client.parse_queries(raw_content)
+        self.assertEqual(queries, parser_client.parse_queries(content))
+        self.assertEqual(
+            parser_client.parse_table_information(queries[1].encode("utf-8")),
+            parser_client.parse_table_information(queries[1]),
+        )
+
+    def test_parse_module_needs_htm_after_every_contentlibrary(self, m_post):
+        parser_client = ResponsysModuleParser(
+            module_names=[],
+            find_containing_modules=True,
+            find_tables=False,
+            print_content=False,
+        )
+        content = b"$document(contentlibrary/a, b.htm)$ contentlibrary without it"
+        self.assertEqual(parser_client.parse_module(content), [])
+
+    def test_get_contents_returns_cached_bytes_when_raw(self, m_post):
+        fake_redis.set("/contentlibrary/raw/cached.htm", "caché")
+        parser_client = ResponsysParser(None)
+        contents = parser_client.get_contents(
+            ["/contentlibrary/raw/cached.htm"], raw=True
+        )
+        fake_redis.delete("/contentlibrary/raw/cached.htm")
+        self.assertEqual(
+            contents, {"/contentlibrary/raw/cached.htm": "caché".encode("utf-8")}
+        )
+
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_iter_parse_yields_results_per_module(self, m_get, m_post):
+        # The switches which are not given are off
+        parser_client = ResponsysModuleParser(
+            module_names=["generic.htm", "containing.htm"],
+            find_containing_modules=True,
+        )
+        results = list(parser_client.iter_parse(workers=2))
+        self.assertEqual(len(results), 2)
+        module_names = {
+            result.module_name
+            for list_of_queries in results
+            for result in list_of_queries
+        }
+        self.assertIn("generic.htm", module_names)
+        self.assertIn("contentlibrary/modules/contained.htm", module_names)
+
     def tearDown(self):
         fake_redis.delete(RESPONSYS_AUTH_TOKEN_KEY)
 
 
+class TestModuleResult(TestCase):
+    def test_reads_like_the_legacy_dict(self):
+        result = ModuleResult(
+            "a.htm",
+            ["$LOOKUP(A)$"],
+            content="<p>a</p>",
+            tables={"ALL_USERS": [{"fieldName": "TITLE"}]},
+            members={"RIID_": {"TITLE": "John Doe"}},
+        )
+        self.assertEqual(
+            list(result.keys()),
+            [
+                "module_name",
+                "queries",
+                "content",
+                "called_modules",
+                "TABLE-ALL_USERS",
+                "MEMBER-RIID_",
+            ],
+        )
+        self.assertEqual(result["MEMBER-RIID_"], {"TITLE": "John Doe"})
+        self.assertTrue("TABLE-ALL_USERS" in result)
+        self.assertFalse("TABLE-OTHER" in result)
+        self.assertEqual(
+            ModuleResult.from_dict(result.to_dict()).to_dict(), result.to_dict()
+        )
+        self.assertFalse(hasattr(result, "__dict__"))
+
+    def test_dropped_content_is_reloaded(self):
+        loader = mock.Mock(return_value="<p>a</p>")
+        result = ModuleResult("a.htm", [], content="<p>a</p>")
+        result.drop_content(loader)
+        self.assertEqual(result.content, "<p>a</p>")
+        self.assertEqual(result["content"], "<p>a</p>")
+        loader.assert_called_with("a.htm")
+
+
+@mock.patch("redis_ops.redis_client", fake_redis)
+class TestParseCache(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_parsed_content_is_shared_by_hash_in_memory_and_redis(self):
+        cache = ParseCache(size=1)
+        parsed = ParsedContent(["contentlibrary/a, b.htm"], ["$a()$"], [])
+        key = cache.key("<p>é</p>")
+        self.assertEqual(key, cache.key("<p>é</p>".encode("utf-8")))
+        cache.set(key, parsed)
+        self.assertIs(cache.get(key), parsed)
+
+        cache.set(cache.key("<p>other</p>"), parsed)
+        self.assertEqual(list(cache.entries), [cache.key("<p>other</p>")])
+        from_redis = cache.get(key)
+        self.assertEqual(from_redis.includes, parsed.includes)
+        self.assertEqual(from_redis.queries, parsed.queries)
+        fake_redis.delete(key, cache.key("<p>other</p>"))
+
+    @mock.patch("requests.post", side_effect=mocked_post_request)
+    def test_identical_content_is_parsed_once(self, m_post):
+        parser_client = ResponsysModuleParser(
+            module_names=[],
+            find_containing_modules=True,
+            find_tables=True,
+            print_content=False,
+            parse_cache=ParseCache(use_redis=False),
+        )
+        content = CONTAINED_MODULE_RESPONSE["content"]
+        with mock.patch.object(
+            parser_client, "get_table", return_value=TABLE_RESPONSE["fields"]
+        ):
+            with mock.patch.object(
+                parser_client, "parse_queries", wraps=parser_client.parse_queries
+            ) as m_parse_queries:
+                first = parser_client.parse_content("en/a.htm", content=content)[0]
+                second = parser_client.parse_content("de/a.htm", content=content)[0]
+        m_parse_queries.assert_called_once()
+        self.assertEqual(first.queries, second.queries)
+        self.assertEqual(first.lookups, second.lookups)
+        self.assertEqual(first.tables, second.tables)
+
+
+class TestLibrarySnapshot(TestCase):
+    def test_diff_reports_transitive_dependents(self):
+        old = LibrarySnapshot(["modules"])
+        old.add_module("/a.htm", "1", ["/b.htm"], ["$LOOKUP(A)"], [])
+        old.add_module("/b.htm", "2", ["/c.htm"], [], [])
+        old.add_module("/c.htm", "3", [], ["$LOOKUP(C)"], ["ALL_USERS"])
+        old.add_module("/d.htm", "4", [], [], [])
+        new = LibrarySnapshot(["modules"])
+        new.modules = dict(old.modules)
+        new.add_module("/c.htm", "5", [], ["$LOOKUP(D)"], [])
+
+        diff = diff_snapshots(old, new)
+
+        self.assertEqual(diff["added"], [])
+        self.assertEqual(diff["removed"], [])
+        self.assertEqual(diff["changed"]["/c.htm"]["queries_added"], ["$LOOKUP(D)"])
+        self.assertEqual(diff["changed"]["/c.htm"]["tables_removed"], ["ALL_USERS"])
+        self.assertEqual(diff["affected"], {"/a.htm": ["/b.htm"], "/b.htm": ["/c.htm"]})
+        self.assertIn("/a.htm (includes /b.htm)", format_diff(diff))
+
+
+class TestContentUpdater(TestCase):
+    def test_literal_replacements_do_not_expand_backslashes(self):
+        update = plan_update(
+            "/a.htm",
+            "$LOOKUP(A)$\n$LOOKUP(A)$\n",
+            [Replacement("LOOKUP(A)", r"LOOKUP(B\1)")],
+        )
+        self.assertEqual(update.updated, "$LOOKUP(B\\1)$\n$LOOKUP(B\\1)$\n")
+        self.assertEqual(update.count, 2)
+        self.assertIn("-$LOOKUP(A)$", update.diff())
+        self.assertIsNone(plan_update("/a.htm", "<p></p>", [Replacement("A", "B")]))
+
+    def test_rate_limiter_spaces_calls(self):
+        rate_limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(5):
+            rate_limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 50)
+
+
+class TestScanQueue(TestCase):
+    def setUp(self):
+        patcher = mock.patch("redis_ops.redis_client", fake_redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = ScanQueue("test")
+        self.queue.create("KEYWORD", ["modules"])
+        self.queue.enqueue("modules", ["/a.htm", "/b.htm", "/c.htm"])
+
+    def test_leased_modules_are_claimed_once(self):
+        first = self.queue.claim(2)
+        second = self.queue.claim(2)
+        self.assertEqual(first, [("modules", 0, "/a.htm"), ("modules", 1, "/b.htm")])
+        self.assertEqual(second, [("modules", 2, "/c.htm")])
+        self.assertEqual(self.queue.claim(2), [])
+
+        self.queue.mark_listed()
+        self.queue.complete({first[0]: True, first[1]: False})
+        self.assertFalse(self.queue.is_finished())
+        self.queue.complete({second[0]: False})
+        self.assertTrue(self.queue.is_finished())
+        self.assertEqual(self.queue.results()[first[0]], MATCH)
+        self.assertEqual(self.queue.progress(), {"total": 3, "done": 3, "pending": 0})
+        # Keys created after the modules were enqueued expire too
+        for key in self.queue.keys:
+            if key != self.queue.key("pending"):
+                self.assertGreater(fake_redis.ttl(key), 0, key)
+
+    def test_modules_of_expired_leases_are_retried_until_given_up(self):
+        for _ in range(SCAN_MAX_ATTEMPTS):
+            # A worker claims the modules and dies
+            self.assertEqual(len(self.queue.claim(3, lease_seconds=0)), 3)
+        with mock.patch("builtins.print"):
+            self.assertEqual(self.queue.claim(3), [])
+        self.assertEqual(set(self.queue.results().values()), {SCAN_FAILED})
+
+    def tearDown(self):
+        self.queue.delete()
+
+
+class TestTemplateExpander(TestCase):
+    def setUp(self):
+        self.library = {
+            "/contentlibrary/m/a.htm": "<a>$document(contentlibrary/m, shared.htm)$</a>",
+            "/contentlibrary/m/b.htm": "<b>$documentnobr(contentlibrary/m, shared.htm)$"
+            "$document(/contentlibrary/m, missing.htm)$</b>",
+            "/contentlibrary/m/shared.htm": "\n<s>$document(contentlibrary/m, leaf.htm)$</s>\n",
+            "/contentlibrary/m/leaf.htm": "leaf",
+            "/contentlibrary/m/loop.htm": "<l>$document(contentlibrary/m, loop.htm)$</l>",
+        }
+        self.loader = mock.Mock(side_effect=self.library.get)
+        self.expander = TemplateExpander(self.loader)
+
+    def test_expands_includes_recursively_once_per_fragment(self):
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/a.htm"),
+            "<a>\n<s>leaf</s>\n</a>",
+        )
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/b.htm"),
+            "<b><s>leaf</s>$document(/contentlibrary/m, missing.htm)$</b>",
+        )
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/loop.htm"),
+            self.library["/contentlibrary/m/loop.htm"],
+        )
+        loaded = [call[0][0] for call in self.loader.call_args_list]
+        self.assertEqual(len(loaded), len(set(loaded)))
+        self.assertIsNone(self.expander.expand("/contentlibrary/m/unknown.htm"))
+
+    def test_expands_includes_nested_in_other_tags(self):
+        library = {
+            CONTAINING_MODULE_RESPONSE["documentPath"]: CONTAINING_MODULE_RESPONSE[
+                "content"
+            ],
+            CONTAINED_MODULE_RESPONSE["documentPath"]: CONTAINED_MODULE_RESPONSE[
+                "content"
+            ],
+        }
+        expander = TemplateExpander(library.get)
+        expanded = expander.expand(CONTAINING_MODULE_RESPONSE["documentPath"])
+        self.assertEqual(
+            expander.includes[CONTAINING_MODULE_RESPONSE["documentPath"]],
+            [CONTAINED_MODULE_RESPONSE["documentPath"]],
+        )
+        self.assertEqual(
+            expanded,
+            "<html>$COND(EMPTY(LOOKUP(WISHLIST_COURSES)), NOTHING(),{})</html>".format(
+                CONTAINED_MODULE_RESPONSE["content"]
+            ),
+        )
+
+    def test_failed_loads_are_retried(self):
+        leaf = self.library.pop("/contentlibrary/m/leaf.htm")
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/a.htm"),
+            "<a>\n<s>$document(contentlibrary/m, leaf.htm)$</s>\n</a>",
+        )
+        self.assertEqual(self.expander.expanded, {})
+
+        self.library["/contentlibrary/m/leaf.htm"] = leaf
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/a.htm"),
+            "<a>\n<s>leaf</s>\n</a>",
+        )
+        self.loader.reset_mock()
+        self.expander.expand("/contentlibrary/m/a.htm")
+        self.loader.assert_not_called()
+
+    def test_invalidate_only_drops_ancestors(self):
+        for module_name in ("a", "b", "leaf", "loop"):
+            self.expander.expand("/contentlibrary/m/{}.htm".format(module_name))
+        self.library["/contentlibrary/m/leaf.htm"] = "new leaf"
+
+        invalidated = self.expander.invalidate("/contentlibrary/m/leaf.htm")
+
+        self.assertEqual(
+            invalidated,
+            {
+                "/contentlibrary/m/a.htm",
+                "/contentlibrary/m/b.htm",
+                "/contentlibrary/m/shared.htm",
+                "/contentlibrary/m/leaf.htm",
+            },
+        )
+        self.assertEqual(
+            self.expander.expand("/contentlibrary/m/a.htm"),
+            "<a>\n<s>new leaf</s>\n</a>",
+        )
+        self.loader.reset_mock()
+        self.expander.expand("/contentlibrary/m/loop.htm")
+        self.loader.assert_not_called()
+
+
 @mock.patch("redis_ops.redis_client", fake_redis)
 class TestResponsysFolderScanner(TestCase):
     @mock.patch("meteorsys.write_queries_to_file")
@@ -292,6 +758,153 @@ class TestResponsysFolderScanner(TestCase):
             self.assertEqual(write_call_args[0], "SOMEVARIABLE")
             self.assertTrue("generic.htm" not in write_call_args[1])
 
+    @mock.patch("meteorsys.write_queries_to_file")
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_folder_scanner_resumes_from_checkpoint(self, m_get, m_write):
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "CHECKPOINT.json")
+        checkpoint = ScanCheckpoint(checkpoint_path, "SOMEVARIABLE", ["modules"])
+        checkpoint.mark_completed(
+            "/contentlibrary/modules/generic.htm",
+            ("modules", 0, "/contentlibrary/modules/generic.htm"),
+        )
+        checkpoint.save()
+
+        with mock.patch.object(
+            ResponsysFolderScanner,
+            "parse_content",
+            autospec=True,
+            side_effect=mock_parse_content,
+        ) as m_parse:
+            parser_client = ResponsysFolderScanner(
+                keyword="SOMEVARIABLE",
+                folder_names=["modules"],
+                resume=True,
+                checkpoint_path=checkpoint_path,
+            )
+            parser_client.execute()
+
+        parsed = [call[0][1] for call in m_parse.call_args_list]
+        self.assertEqual(parsed, ["/contentlibrary/modules/containing.htm"])
+        self.assertTrue("generic.htm" in m_write.call_args_list[0][0][1])
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_folder_scanner_keeps_checkpoint_of_failed_scan(self, m_get, m_write):
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "CHECKPOINT.json")
+        m_write.side_effect = KeyboardInterrupt
+        parser_client = ResponsysFolderScanner(
+            keyword="SOMEVARIABLE",
+            folder_names=["modules"],
+            checkpoint_path=checkpoint_path,
+        )
+        with self.assertRaises(KeyboardInterrupt):
+            parser_client.execute()
+
+        checkpoint = ScanCheckpoint.load(checkpoint_path)
+        self.assertEqual(len(checkpoint.completed), 2)
+        self.assertTrue(checkpoint.is_compatible("SOMEVARIABLE", ["modules"]))
+        self.assertFalse(checkpoint.is_compatible("OTHER", ["modules"]))
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_iter_scan_yields_matches_without_report(self, m_get, m_write):
+        parser_client = ResponsysFolderScanner(
+            keyword="SOMEVARIABLE", folder_names=["modules"]
+        )
+        with mock.patch("builtins.print"):
+            matches = list(
+                parser_client.iter_scan(keywords=["SOMEVARIABLE", "NOT_USED"])
+            )
+        self.assertIn(
+            ScanMatch(
+                "modules", "/contentlibrary/modules/generic.htm", ["SOMEVARIABLE"]
+            ),
+            matches,
+        )
+        m_write.assert_not_called()
+
+
+@mock.patch("redis_ops.redis_client", fake_redis)
+@mock.patch("requests.post", side_effect=mocked_post_request)
+class TestResponsysContentIndexer(TestCase):
+    def setUp(self):
+        self.index_path = os.path.join(tempfile.mkdtemp(), "INDEX.json")
+
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_index_folders_indexes_variables_functions_and_tables(self, m_get, m_post):
+        indexer = ResponsysContentIndexer(
+            folder_names=["modules"], index_path=self.index_path
+        )
+        indexer.execute()
+
+        index = ContentIndex.load(self.index_path)
+        generic = "/contentlibrary/modules/generic.htm"
+        content = CONTENT_RESPONSE["content"]
+        offsets = index.lookup("SOMEVARIABLE", "variable")[generic]
+        self.assertEqual(content[offsets[0] :].find("SOMEVARIABLE"), 0)
+        self.assertEqual(len(index.lookup("LOOKUP", "function")[generic]), 3)
+        self.assertIn("/contentlibrary/modules/containing.htm", index.lookup("COND"))
+
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_index_folders_reindexes_changed_modules(self, m_get, m_post):
+        generic = "/contentlibrary/modules/generic.htm"
+        index = ContentIndex()
+        index.add_module(generic, hash_content("old"), [("variable", "OLD", 1)])
+        index.add_module("/contentlibrary/modules/removed.htm", "1", [])
+        index.add_module("/contentlibrary/modules/sub/kept.htm", "2", [])
+        index.save(self.index_path)
+        # The cached copy is stale, the module changed in Responsys
+        save_to_redis(generic, "old")
+
+        indexer = ResponsysContentIndexer(
+            folder_names=["modules"], index_path=self.index_path
+        )
+        indexer.execute()
+
+        index = ContentIndex.load(self.index_path)
+        self.assertEqual(index.lookup("OLD"), {})
+        self.assertIn(generic, index.lookup("SOMEVARIABLE"))
+        self.assertEqual(get_from_redis(generic), CONTENT_RESPONSE["content"])
+        self.assertNotIn("/contentlibrary/modules/removed.htm", index.modules)
+        self.assertIn("/contentlibrary/modules/sub/kept.htm", index.modules)
+
+    def test_save_to_a_bare_file_name(self, m_post):
+        directory = os.getcwd()
+        os.chdir(os.path.dirname(self.index_path))
+        try:
+            ContentIndex().save("INDEX.json")
+        finally:
+            os.chdir(directory)
+        self.assertTrue(os.path.exists(self.index_path))
+
+    def test_extract_index_terms_finds_tables(self, m_post):
+        indexer = ResponsysContentIndexer(
+            folder_names=["modules"], index_path=self.index_path
+        )
+        content = CONTAINED_MODULE_RESPONSE["content"]
+        occurrences = indexer.extract_index_terms(content)
+        tables = [o for o in occurrences if o[0] == "table"]
+        self.assertEqual(tables[0][1], "ALL_USERS")
+        self.assertEqual(content[tables[0][2] :].find("ALL_USERS"), 0)
+        self.assertIn(("function", "LOOKUPRECORDS"), [o[:2] for o in occurrences])
+
+    def test_add_module_replaces_previous_postings(self, m_post):
+        index = ContentIndex()
+        index.add_module("a.htm", "hash1", [("variable", "OLD", 1)])
+        index.add_module("a.htm", "hash2", [("variable", "NEW", 2)])
+        index.save(self.index_path)
+
+        index = ContentIndex.load(self.index_path)
+        self.assertEqual(index.lookup("OLD"), {})
+        self.assertEqual(index.lookup("NEW"), {"a.htm": [2]})
+        self.assertTrue(index.is_current("a.htm", "hash2"))
+
+    def tearDown(self):
+        fake_redis.delete(
+            RESPONSYS_AUTH_TOKEN_KEY, "/contentlibrary/modules/generic.htm"
+        )
+
 
 @mock.patch("redis_ops.redis_client", fake_redis)
 @mock.patch("meteorsys.get_input_modules")
@@ -405,6 +1018,660 @@ class TestMain(TestCase):
         self.assertEqual(proceed, "y")
 
 
+@mock.patch("redis_ops.redis_client", fake_redis)
+class TestJobs(TestCase):
+    def test_build_arg_parser_parses_scan_command(self):
+        args = build_arg_parser().parse_args(
+            ["scan", "--keyword", "SOMEVARIABLE", "--folders", "modules", "other"]
+        )
+        self.assertEqual(args.command, "scan")
+        self.assertEqual(args.keyword, "SOMEVARIABLE")
+        self.assertEqual(args.folders, ["modules", "other"])
+
+    def test_build_arg_parser_rejects_non_positive_workers(self):
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            build_arg_parser().parse_args(["scan", "--parse-workers", "0"])
+
+    @mock.patch("meteorsys.run_jobs", return_value=0)
+    def test_main_with_arguments_runs_job(self, m_run_jobs):
+        with self.assertRaises(SystemExit) as context:
+            main(["parse", "generic", "--find-tables"])
+        self.assertEqual(context.exception.code, 0)
+        job = m_run_jobs.call_args_list[0][0][0][0]
+        self.assertEqual(job["modules"], ["generic"])
+        self.assertTrue(job["find_tables"])
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    @mock.patch("meteorsys.requests.Session")
+    def test_run_jobs_shares_session_and_token(self, m_session, m_write):
+        session = m_session.return_value
+        session.post.side_effect = mocked_post_request
+        session.get.side_effect = mocked_get_request
+        job_file = os.path.join(tempfile.mkdtemp(), "jobs.json")
+        with open(job_file, "w") as file:
+            file.write(
+                '{"jobs": [{"command": "scan", "keyword": "SOMEVARIABLE"},'
+                '{"command": "scan", "keyword": "VARIABLE"}]}'
+            )
+
+        failures = run_jobs(load_jobs(job_file), workers=2)
+
+        self.assertEqual(failures, 0)
+        self.assertEqual(session.post.call_count, 1)
+        keywords = sorted(call[0][0] for call in m_write.call_args_list)
+        self.assertEqual(keywords, ["SOMEVARIABLE", "VARIABLE"])
+
+    def tearDown(self):
+        fake_redis.delete(RESPONSYS_AUTH_TOKEN_KEY)
+        for document in LIST_CONTENTS_RESPONSE["documents"]:
+            fake_redis.delete(document["documentPath"])
+
+
+@mock.patch("redis_ops.redis_client", fake_redis)
+@mock.patch("requests.post", side_effect=mocked_post_request)
+class TestMetrics(TestCase):
+    def setUp(self):
+        metrics.reset()
+        parse_cache.clear()
+        for key in fake_redis.scan_iter("parse_result:*"):
+            fake_redis.delete(key)
+
+    @mock.patch("decorators.get_from_redis", side_effect=lambda key: None)
+    @mock.patch("requests.get", side_effect=mocked_get_request)
+    def test_parse_content_records_requests_cache_and_stages(
+        self, m_get, m_get_from_redis, m_post
+    ):
+        parser_client = ResponsysModuleParser(
+            module_names=["containing.htm"],
+            find_containing_modules=True,
+            find_tables=True,
+            print_content=False,
+        )
+        parser_client.parse_content("containing.htm", 1)
+
+        data = metrics.to_dict()
+        histograms = {
+            (h["name"], tuple(sorted(h["labels"].values()))): h
+            for h in data["histograms"]
+        }
+        self.assertEqual(
+            histograms[("http_request_seconds", ("200", "content"))]["count"], 2
+        )
+        self.assertEqual(histograms[("cache_seconds", ("miss", "redis"))]["count"], 2)
+        self.assertEqual(
+            histograms[("stage_seconds", ("include_extraction",))]["count"], 2
+        )
+        self.assertIn(("stage_seconds", ("table_parsing",)), histograms)
+        self.assertIn("HTTP requests:", metrics.summary())
+
+    def test_to_prometheus_formats_histograms_and_counters(self, m_post):
+        run_metrics = RunMetrics()
+        run_metrics.record_request("content", 0.02, 100, "200")
+        text = run_metrics.to_prometheus()
+        self.assertIn("# TYPE meteorsys_http_request_seconds histogram", text)
+        self.assertIn(
+            'meteorsys_http_request_seconds_bucket{endpoint="content",status="200",le="0.01"} 0',
+            text,
+        )
+        self.assertIn(
+            'meteorsys_http_request_seconds_bucket{endpoint="content",status="200",le="0.025"} 1',
+            text,
+        )
+        self.assertIn(
+            'meteorsys_http_response_bytes_total{endpoint="content",status="200"} 100',
+            text,
+        )
+
+    def tearDown(self):
+        fake_redis.delete(RESPONSYS_AUTH_TOKEN_KEY)
+
+
+class TestBenchmarks(TestCase):
+    def test_generate_library_is_seeded(self):
+        library = generate_library(seed=1, modules=5, size=500)
+        self.assertEqual(library, generate_library(seed=1, modules=5, size=500))
+        self.assertNotEqual(library, generate_library(seed=2, modules=5, size=500))
+
+    @mock.patch("requests.post", side_effect=mocked_post_request)
+    def test_generated_includes_are_parsed(self, m_post):
+        library = generate_library(seed=1, modules=4, size=500, includes=2)
+        parser_client = ResponsysModuleParser(
+            module_names=[],
+            find_containing_modules=True,
+            find_tables=False,
+            print_content=False,
+            token="token",
+        )
+        first = library["/contentlibrary/modules/module_0000.htm"]
+        module_paths = sorted(
+            "/" + parser_client.build_module_path(name)
+            for name in parser_client.parse_module(first)
+        )
+        self.assertEqual(len(module_paths), 2)
+        for module_path in module_paths:
+            self.assertIn(module_path, library)
+        m_post.assert_not_called()
+
+    def test_run_benchmarks_reports_time_and_memory(self):
+        results = run_benchmarks(modules=3, size=500, repeat=1)
+        self.assertEqual(
+            sorted(results),
+            [
+                "build_module_path",
+                "format_list",
+                "parse_module",
+                "parse_module_bytes",
+                "parse_queries",
+                "parse_queries_bytes",
+                "parse_table_information",
+            ],
+        )
+        for result in results.values():
+            self.assertGreaterEqual(result["peak_memory_kb"], 0)
+
+
+class TestDaemon(TestCase):
+    def test_single_flight_runs_identical_calls_once(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "result"
+
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do("key", slow_call))
+        )
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(
+            target=lambda: results.append(flights.do("key", slow_call))
+        )
+        follower.start()
+        # Gives the follower time to join the call in flight
+        time.sleep(0.2)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("result", False), ("result", True)])
+        self.assertEqual(flights.do("key", lambda: "again"), ("again", False))
+
+    @mock.patch.object(MeteorsysDaemon, "client_kwargs")
+    def test_parameters_of_the_wrong_type_are_rejected(self, m_client_kwargs):
+        daemon = MeteorsysDaemon()
+        for name, params in (
+            ("parse", {"modules": "generic"}),
+            ("parse", {"modules": ["generic"], "find_tables": "false"}),
+            ("parse", {"modules": ["generic"], "folder": ["modules"]}),
+            ("scan", {"folders": "modules"}),
+            ("scan", {"recursive": "true"}),
+            ("scan", {"fetch_workers": True}),
+            ("scan", {"fetch_workers": 0}),
+            ("scan", {"parse_workers": -1}),
+            ("lookup", {"term": ["A"]}),
+        ):
+            status, response = daemon.handle(name, params)
+            self.assertEqual(status, 400, (name, params))
+            self.assertIn("must be", response["error"])
+        # Nothing is requested for rejected parameters
+        m_client_kwargs.assert_not_called()
+
+    def test_parse_and_scan_require_post(self):
+        server = DaemonHTTPServer(MeteorsysDaemon(), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://{}:{}".format(*server.server_address[:2])
+        try:
+            for path in ("/parse?modules=generic", "/scan?folders=modules"):
+                self.assertEqual(requests.get(url + path).status_code, 405)
+            self.assertEqual(requests.get(url + "/health").status_code, 200)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @mock.patch("redis_ops.redis_client", fake_redis)
+    def test_expand_keeps_subtrees_until_invalidated(self):
+        library = {
+            "/contentlibrary/m/a.htm": "<a>$document(contentlibrary/m, leaf.htm)$</a>",
+            "/contentlibrary/m/leaf.htm": "leaf",
+        }
+        params = {"modules": ["a"], "folder": "m"}
+        with mock.patch.object(
+            MeteorsysDaemon, "load_content", side_effect=library.get
+        ) as m_load_content:
+            daemon = MeteorsysDaemon()
+            status, response = daemon.handle("expand", params)
+            self.assertEqual(status, 200)
+            self.assertEqual(response["results"][0]["content"], "<a>leaf</a>")
+
+            library["/contentlibrary/m/leaf.htm"] = "new leaf"
+            daemon.handle("expand", params)
+            self.assertEqual(m_load_content.call_count, 2)
+            status, response = daemon.handle(
+                "invalidate", {"modules": ["leaf"], "folder": "m"}
+            )
+            self.assertEqual(
+                response["invalidated"],
+                ["/contentlibrary/m/a.htm", "/contentlibrary/m/leaf.htm"],
+            )
+            status, response = daemon.handle("expand", params)
+            self.assertEqual(response["results"][0]["content"], "<a>new leaf</a>")
+
+    def test_unix_socket_server_answers_requests(self):
+        path = os.path.join(tempfile.mkdtemp(), "meteorsys.sock")
+        server = DaemonUnixServer(MeteorsysDaemon(), path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path)
+                client.sendall(
+                    b"GET /health HTTP/1.1\r\nHost: meteorsys\r\n"
+                    b"Connection: close\r\n\r\n"
+                )
+                response = b""
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    response += data
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200"))
+        self.assertIn(b'"status": "ok"', response)
+        self.assertFalse(os.path.exists(path))
+
+
+@mock.patch("redis_ops.redis_client", fake_redis)
+class TestStandInServer(TestCase):
+    def setUp(self):
+        self.library = generate_library(seed=3, modules=5, size=300, folder="standin")
+        self.server = StandInServer(
+            self.library, StandInConfig(throttle_rate=0.2, seed=1)
+        ).start()
+        settings.configure(**self.server.urls())
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    def test_scan_retries_throttled_requests(self, m_write):
+        parser_client = ResponsysFolderScanner(
+            keyword="document", folder_names=["standin"], session=requests.Session()
+        )
+        parser_client.execute()
+        content = m_write.call_args_list[0][0][1]
+        # Every module but the last one includes another module
+        for module_name in sorted(self.library)[:-1]:
+            self.assertIn(module_name, content)
+        self.assertNotIn(sorted(self.library)[-1], content)
+        # Login, listing and one request per module plus the throttled retries
+        self.assertGreater(self.server.request_count, len(self.library) + 2)
+
+    def test_snapshot_reports_changes_since_base(self):
+        self.server.config.throttle_rate = 0.0
+        directory = tempfile.mkdtemp()
+        base_path = os.path.join(directory, "base.json")
+        ResponsysLibrarySnapshotter(
+            folder_names=["standin"],
+            snapshot_path=base_path,
+            session=requests.Session(),
+        ).execute()
+
+        modules = sorted(self.library)
+        self.library[modules[4]] += "\n$LOOKUP(NEW_VARIABLE)$"
+        del self.library[modules[3]]
+        added = "/contentlibrary/standin/added.htm"
+        self.library[added] = "<p>$LOOKUP(ADDED)$</p>"
+
+        snapshotter = ResponsysLibrarySnapshotter(
+            folder_names=None,
+            snapshot_path=os.path.join(directory, "new.json"),
+            base_path=base_path,
+            report_path=os.path.join(directory, "DIFF.notes"),
+            session=requests.Session(),
+        )
+        snapshotter.execute()
+
+        self.assertEqual(snapshotter.parsed, 2)
+        diff = diff_snapshots(
+            LibrarySnapshot.load(base_path),
+            LibrarySnapshot.load(os.path.join(directory, "new.json")),
+        )
+        self.assertEqual(diff["added"], [added])
+        self.assertEqual(diff["removed"], [modules[3]])
+        self.assertEqual(
+            diff["changed"][modules[4]]["queries_added"], ["$LOOKUP(NEW_VARIABLE)"]
+        )
+        base = LibrarySnapshot.load(base_path)
+        for module_name in diff["affected"]:
+            self.assertNotIn(module_name, (modules[3], modules[4]))
+        # Every module including a changed or removed module is affected
+        for include in (modules[3], modules[4]):
+            for module_name in base.dependents().get(include, ()):
+                if module_name not in (modules[3], modules[4]):
+                    self.assertIn(include, diff["affected"][module_name])
+        with open(os.path.join(directory, "DIFF.notes")) as file:
+            self.assertIn("queries added: $LOOKUP(NEW_VARIABLE)", file.read())
+
+    def test_daemon_serves_parse_scan_and_lookup(self):
+        self.server.config.throttle_rate = 0.0
+        index_path = os.path.join(tempfile.mkdtemp(), "INDEX.json")
+        index = ContentIndex()
+        index.add_module("/contentlibrary/standin/a.htm", "1", [("variable", "A", 3)])
+        index.save(index_path)
+        daemon_server = DaemonHTTPServer(MeteorsysDaemon(index_path), port=0)
+        threading.Thread(target=daemon_server.serve_forever, daemon=True).start()
+        url = "http://{}:{}".format(*daemon_server.server_address[:2])
+        try:
+            response = requests.post(
+                url + "/parse",
+                json={"modules": ["module_0003"], "folder": "standin"},
+            )
+            self.assertEqual(response.status_code, 200)
+            result = response.json()["results"][0]
+            self.assertEqual(result["module_name"], sorted(self.library)[3])
+            self.assertTrue(result["queries"])
+
+            response = requests.post(
+                url + "/scan", json={"keyword": "document", "folders": ["standin"]}
+            )
+            module_names = [m["module_name"] for m in response.json()["matches"]]
+            self.assertEqual(module_names, sorted(self.library)[:-1])
+
+            response = requests.get(url + "/lookup", params={"term": "A"})
+            self.assertEqual(
+                response.json()["modules"], {"/contentlibrary/standin/a.htm": [3]}
+            )
+            response = requests.get(url + "/lookup")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(requests.get(url + "/health").json()["requests"], 5)
+        finally:
+            daemon_server.shutdown()
+            daemon_server.server_close()
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    def test_recursive_scan_walks_subfolders_and_caches_the_tree(self, m_write):
+        self.server.config.throttle_rate = 0.0
+        tree = {
+            "/contentlibrary/standin/tree/a.htm": "<p>$LOOKUP(TREE_KEY)$</p>",
+            "/contentlibrary/standin/tree/sub/b.htm": "<p>$LOOKUP(TREE_KEY)$</p>",
+            "/contentlibrary/standin/tree/sub/deeper/c.htm": "<p>$LOOKUP(OTHER)$</p>",
+            "/contentlibrary/standin/tree/other/d.htm": "<p>$LOOKUP(TREE_KEY)$</p>",
+        }
+        self.library.update(tree)
+        parser_client = ResponsysFolderScanner(
+            keyword="TREE_KEY",
+            folder_names=["standin/tree"],
+            recursive=True,
+            session=requests.Session(),
+        )
+        parser_client.execute()
+
+        content = m_write.call_args_list[0][0][1]
+        self.assertIn("--- standin/tree/sub/deeper ---", content)
+        for module_name in sorted(tree):
+            if "deeper" in module_name:
+                self.assertNotIn(module_name, content)
+            else:
+                self.assertIn(module_name, content)
+        self.assertLess(
+            content.index("--- standin/tree/other ---"),
+            content.index("--- standin/tree/sub ---"),
+        )
+
+        # The second walk is served from the cached folder tree
+        request_count = self.server.request_count
+        folders = dict(parser_client.walk_folders(["standin/tree"]))
+        self.assertEqual(self.server.request_count, request_count)
+        self.assertEqual(
+            folders["standin/tree/sub"], ["/contentlibrary/standin/tree/sub/b.htm"]
+        )
+
+        # A fresh walk lists the folders again and updates the cached tree
+        self.library["/contentlibrary/standin/tree/sub/e.htm"] = "<p>e</p>"
+        folders = dict(parser_client.walk_folders(["standin/tree"], fresh=True))
+        self.assertGreater(self.server.request_count, request_count)
+        self.assertIn(
+            "/contentlibrary/standin/tree/sub/e.htm", folders["standin/tree/sub"]
+        )
+        folders = dict(parser_client.walk_folders(["standin/tree"]))
+        self.assertIn(
+            "/contentlibrary/standin/tree/sub/e.htm", folders["standin/tree/sub"]
+        )
+        fake_redis.delete(FOLDER_TREE_KEY.format(folder_name="standin/tree"))
+
+    def test_expired_token_is_refreshed(self):
+        self.server.config.throttle_rate = 0.0
+        self.server.config.token_ttl = 0.2
+        parser = ResponsysParser(None, session=requests.Session())
+        token = parser.token
+        time.sleep(0.3)
+        module_name = sorted(self.library)[0]
+        self.assertEqual(parser.get_content(module_name), self.library[module_name])
+        self.assertNotEqual(parser.token, token)
+
+    @mock.patch("meteorsys.write_queries_to_file")
+    def test_distributed_scan_matches_local_scan(self, m_write):
+        self.server.config.throttle_rate = 0.0
+        parser_client = ResponsysFolderScanner(
+            keyword="document", folder_names=["standin"], session=requests.Session()
+        )
+        with mock.patch("builtins.print"):
+            expected = parser_client.scan_folder_for_keyword(
+                "document", ["standin"], write_report=False
+            )
+
+        coordinator = ResponsysScanCoordinator(
+            keyword="document",
+            folder_names=["standin"],
+            local_workers=2,
+            poll_seconds=0.05,
+            session=requests.Session(),
+        )
+        with mock.patch("builtins.print"):
+            matches = coordinator.scan_folder_for_keyword("document", ["standin"])
+        self.assertEqual(matches, expected)
+        content = m_write.call_args_list[0][0][1]
+        for match in expected:
+            self.assertIn(match[2], content)
+        # The queue is removed once the report is written
+        self.assertIsNone(coordinator.queue.info())
+
+    def test_update_replaces_in_scanned_modules(self):
+        self.server.config.throttle_rate = 0.0
+        report_path = os.path.join(tempfile.mkdtemp(), "UPDATE.diff")
+        expected = sorted(
+            name for name, content in self.library.items() if "RIID_" in content
+        )
+        original = dict(self.library)
+
+        updater = ResponsysContentUpdater(
+            replacements=[Replacement("LOOKUP(RIID_)", "LOOKUP(RECIPIENT_ID_)")],
+            folder_names=["standin"],
+            report_path=report_path,
+            session=requests.Session(),
+        )
+        with mock.patch("builtins.print"):
+            self.assertIsNone(updater.execute())
+        # A dry run only writes the diff
+        self.assertEqual(self.library, original)
+        with open(report_path) as file:
+            self.assertIn("+++ {}".format(expected[0]), file.read())
+
+        updater.apply = True
+        with mock.patch("builtins.print"):
+            outcomes = updater.execute()
+        self.assertEqual(outcomes, dict.fromkeys(expected, UPDATED))
+        for module_name in expected:
+            self.assertNotIn("RIID_", self.library[module_name])
+            self.assertIn("LOOKUP(RECIPIENT_ID_)", self.library[module_name])
+            self.assertEqual(get_from_redis(module_name), self.library[module_name])
+
+    def test_update_skips_modules_changed_since_planned(self):
+        self.server.config.throttle_rate = 0.0
+        modules = sorted(self.library)
+        updater = ResponsysContentUpdater(
+            replacements=[Replacement(r"module_(\d+)", r"fragment_\1", regex=True)],
+            module_names=modules[:2],
+            rate=0,
+            session=requests.Session(),
+        )
+        updates = updater.plan_updates(modules[:2])
+        self.assertEqual(len(updates), 2)
+        self.assertIn("fragment_0002.htm", updates[0].updated)
+        self.library[modules[0]] += "<p>edited</p>"
+
+        with mock.patch("builtins.print"):
+            outcomes = updater.push_updates(updates)
+        self.assertEqual(outcomes, {modules[0]: CONFLICT, modules[1]: UPDATED})
+        self.assertEqual(self.library[modules[1]], updates[1].updated)
+        self.assertTrue(self.library[modules[0]].endswith("<p>edited</p>"))
+        self.assertEqual(get_from_redis(modules[0]), self.library[modules[0]])
+
+    def tearDown(self):
+        self.server.stop()
+        settings.reset()
+        fake_redis.delete(RESPONSYS_AUTH_TOKEN_KEY, *self.library)
+
+
+class TestPipeline(TestCase):
+    def test_run_passes_items_through_stages(self):
+        written = []
+        pipeline = Pipeline(
+            [
+                Stage("list", lambda n: range(n), many=True),
+                Stage("double", lambda n: n * 2, workers=4),
+                Stage("drop", lambda n: None if n == 2 else n, workers=2),
+                Stage("write", written.append),
+            ],
+            queue_size=2,
+        )
+        pipeline.run([3, 2])
+        self.assertEqual(sorted(written), [0, 0, 4])
+
+    def test_stage_requires_a_worker(self):
+        with self.assertRaises(ValueError):
+            Stage("parse", str, workers=0)
+
+    def test_run_skips_failed_items(self):
+        written = []
+        pipeline = Pipeline(
+            [Stage("parse", lambda n: 1 / n), Stage("write", written.append)]
+        )
+        with mock.patch("builtins.print"):
+            pipeline.run([1, 0, 2])
+        self.assertEqual(sorted(written), [0.5, 1.0])
+
+    def test_bounded_queues_apply_backpressure(self):
+        produced = []
+
+        def source():
+            for i in range(50):
+                produced.append(i)
+                yield i
+
+        in_flight = []
+
+        def slow_write(item):
+            in_flight.append(len(produced) - item)
+            time.sleep(0.001)
+
+        pipeline = Pipeline(
+            [Stage("parse", lambda n: n), Stage("write", slow_write)], queue_size=3
+        )
+        pipeline.run(source())
+        self.assertEqual(len(produced), 50)
+        # Items in flight are bounded by the two queues and the two workers
+        self.assertLessEqual(max(in_flight), 2 * 3 + 2 + 1)
+
+    def test_cancel_stops_feeding_the_pipeline(self):
+        pipeline = Pipeline([Stage("write", lambda n: pipeline.cancel())], queue_size=1)
+        produced = []
+
+        def source():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        pipeline.run(source())
+        self.assertLess(len(produced), 1000)
+
+    def test_interrupt_while_waiting_for_workers_cancels_them(self):
+        processed = []
+
+        def slow_write(item):
+            time.sleep(0.01)
+            processed.append(item)
+
+        pipeline = Pipeline([Stage("write", slow_write)], queue_size=1000)
+        with mock.patch.object(threading.Thread, "join", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                pipeline.run(range(500))
+        self.assertTrue(pipeline.cancelled.is_set())
+        time.sleep(0.1)
+        self.assertLess(len(processed), 500)
+
+    def test_iter_yields_outputs_of_the_last_stage(self):
+        pipeline = Pipeline(
+            [
+                Stage("list", lambda n: range(n), many=True),
+                Stage("double", lambda n: n * 2, workers=3),
+            ],
+            queue_size=2,
+        )
+        self.assertEqual(sorted(pipeline.iter([3, 2])), [0, 0, 2, 2, 4])
+
+    def test_closing_iter_cancels_the_run(self):
+        produced = []
+
+        def source():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        pipeline = Pipeline([Stage("parse", lambda n: n)], queue_size=1)
+        results = pipeline.iter(source())
+        self.assertEqual(next(results), 0)
+        results.close()
+        self.assertTrue(pipeline.cancelled.is_set())
+        self.assertLess(len(produced), 1000)
+
+    def test_iter_raises_errors_of_the_source(self):
+        def source():
+            yield 1
+            raise ValueError("listing failed")
+
+        pipeline = Pipeline([Stage("parse", lambda n: n)])
+        with self.assertRaises(ValueError):
+            list(pipeline.iter(source()))
+
+
+class TestConfig(TestCase):
+    def test_lazy_settings_resolve_on_first_access(self):
+        lazy_settings = LazySettings(MISSING="METEORSYS_MISSING_SETTING")
+        with mock.patch("config.config", return_value="value") as m_config:
+            self.assertEqual(lazy_settings.MISSING, "value")
+            self.assertEqual(lazy_settings.MISSING, "value")
+        m_config.assert_called_once_with("METEORSYS_MISSING_SETTING")
+
+    def test_lazy_settings_configure_overrides_environment(self):
+        lazy_settings = LazySettings(MISSING="METEORSYS_MISSING_SETTING")
+        lazy_settings.configure(MISSING="http://localhost")
+        self.assertEqual(lazy_settings.MISSING, "http://localhost")
+        with self.assertRaises(AttributeError):
+            lazy_settings.UNKNOWN
+
+    @mock.patch("redis_ops.redis_client", None)
+    @mock.patch("redis_ops.redis.Redis")
+    def test_redis_client_is_constructed_on_first_use(self, m_redis):
+        m_redis.assert_not_called()
+        save_to_redis("key", "value")
+        get_from_redis("key")
+        m_redis.assert_called_once_with()
+
+
 class TestHelpers(TestCase):
     def test_write_queries_to_file(self):
         with mock.patch("builtins.open", mock.mock_open()) as m:
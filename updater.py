@@ -0,0 +1,104 @@
+import difflib
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Outcomes of pushing an update
+UPDATED = "updated"
+CONFLICT = "conflict"
+FAILED = "failed"
+
+
+class Replacement:
+    """Replaces old by new, old being a regular expression when regex is set"""
+
+    def __init__(self, old: str, new: str, regex: bool = False):
+        self.old = old
+        self.new = new
+        self.regex = regex
+        self.pattern = re.compile(old if regex else re.escape(old))
+
+    def apply(self, content: str) -> Tuple[str, int]:
+        """Returns the replaced content and the number of replacements"""
+        if self.regex:
+            return self.pattern.subn(self.new, content)
+        # Literal replacements must not expand backslashes in new
+        return self.pattern.subn(lambda match: self.new, content)
+
+    def __repr__(self):
+        return "Replacement({!r}, {!r}, regex={})".format(
+            self.old, self.new, self.regex
+        )
+
+
+class ContentUpdate:
+    """Edit of one module, planned from the content it was fetched with"""
+
+    __slots__ = ("module_name", "original", "updated", "count")
+
+    def __init__(self, module_name: str, original: str, updated: str, count: int):
+        self.module_name = module_name
+        self.original = original
+        self.updated = updated
+        self.count = count
+
+    def diff(self) -> str:
+        return "".join(
+            difflib.unified_diff(
+                self.original.splitlines(keepends=True),
+                self.updated.splitlines(keepends=True),
+                fromfile=self.module_name,
+                tofile=self.module_name,
+            )
+        )
+
+
+def plan_update(
+    module_name: str, content: str, replacements: List[Replacement]
+) -> Optional[ContentUpdate]:
+    """Returns the edit of a module, or None if no replacement applies"""
+    updated, count = content, 0
+    for replacement in replacements:
+        updated, replaced = replacement.apply(updated)
+        count += replaced
+    if updated == content:
+        return None
+    return ContentUpdate(module_name, content, updated, count)
+
+
+class RateLimiter:
+    """Spaces calls across threads at least 1 / rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def format_updates(
+    updates: List[ContentUpdate], outcomes: Optional[Dict[str, str]] = None
+) -> str:
+    content = (40 * "*") + " UPDATES " + (40 * "*") + "\n"
+    content += "{} modules, {} replacements\n\n".format(
+        len(updates), sum(update.count for update in updates)
+    )
+    for update in updates:
+        content += "{} ({} replacements){}\n".format(
+            update.module_name,
+            update.count,
+            ": {}".format(outcomes[update.module_name]) if outcomes else "",
+        )
+        content += update.diff()
+        content += "\n"
+    return content